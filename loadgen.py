@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+from time import monotonic, sleep
+
+from simulator import Capture, Simulator
+
+
+async def run_spacecraft(args, apids, counters, first):
+    # Drive a group of virtual spacecraft from one event loop, sharing a
+    # single mapped capture.
+    capture = Capture(args.file)
+    simulators = [Simulator(speed=args.speed, batch=args.batch, tc_address=None,
+                            apid=apid, capture=capture) for apid in apids]
+    try:
+        for simulator in simulators:
+            await simulator.start()
+        while not all(simulator.tm_task.done() for simulator in simulators):
+            for i, simulator in enumerate(simulators):
+                counters[first + i] = simulator.tm_counter
+            await asyncio.sleep(0.5)
+        for i, simulator in enumerate(simulators):
+            counters[first + i] = simulator.tm_counter
+    finally:
+        for simulator in simulators:
+            await simulator.stop()
+        capture.close()
+
+
+def worker(args, apids, counters, first):
+    try:
+        asyncio.run(run_spacecraft(args, apids, counters, first))
+    except KeyboardInterrupt:
+        pass
+
+
+def format_status(apids, rates):
+    spacecraft = ', '.join('{}: {:.0f}'.format(apid, rate) for apid, rate in zip(apids, rates))
+    return 'Total: {:.0f} packets/s. Per APID: {}'.format(sum(rates), spacecraft)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send TM for several virtual spacecraft at once')
+    parser.add_argument('--file', default='testdata.ccsds',
+                        help='CCSDS capture to replay (default: %(default)s)')
+    parser.add_argument('--spacecraft', type=int, default=10,
+                        help='number of virtual spacecraft (default: %(default)s)')
+    parser.add_argument('--apid', type=int, default=100,
+                        help='APID of the first spacecraft, the others count up from it (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: %(default)s)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed factor, 0 for as fast as possible (default: %(default)s)')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='max datagrams per sendmmsg call on Linux (default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between reports (default: %(default)s)')
+    args = parser.parse_args()
+
+    apids = list(range(args.apid, args.apid + args.spacecraft))
+    if apids[-1] > 0x7FF:
+        parser.error('APIDs must fit in 11 bits')
+
+    counters = multiprocessing.Array('Q', len(apids), lock=False)
+    workers = []
+    nworkers = max(1, min(args.workers, len(apids)))
+    for w in range(nworkers):
+        first = w * len(apids) // nworkers
+        last = (w + 1) * len(apids) // nworkers
+        process = multiprocessing.Process(target=worker,
+                                          args=(args, apids[first:last], counters, first))
+        process.start()
+        workers.append(process)
+
+    try:
+        prev = list(counters)
+        prev_time = monotonic()
+        while any(process.is_alive() for process in workers):
+            sleep(args.interval)
+            now = monotonic()
+            current = list(counters)
+            rates = [(c - p) / (now - prev_time) for c, p in zip(current, prev)]
+            print(format_status(apids, rates))
+            prev, prev_time = current, now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers:
+            process.join()
+        sys.stdout.flush()
@@ -0,0 +1,291 @@
+import argparse
+import io
+import mmap
+import queue
+import socket
+from array import array
+from struct import Struct, unpack_from
+from threading import Thread
+from time import time_ns
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER = 0x1a2b3c4d
+PCAPNG_IDB = 1
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+IPPROTO_UDP = 17
+
+PCAP_HEADER = Struct('<IHHiIII')
+PCAP_RECORD = Struct('<IIII')
+IPV4_HEADER = Struct('>BBHHHBBH4s4s')
+UDP_HEADER = Struct('>HHHH')
+
+
+def ip_offset(linktype, data, start, end):
+    # Offset of the IP header within a link-layer frame, or None
+    if linktype == LINKTYPE_ETHERNET:
+        offset = start + 12
+        if end < offset + 2:
+            return None
+        ethertype = (data[offset] << 8) | data[offset + 1]
+        while ethertype in ETHERTYPE_VLAN and end >= offset + 6:
+            offset += 4
+            ethertype = (data[offset] << 8) | data[offset + 1]
+        return offset + 2 if ethertype in (ETHERTYPE_IPV4, ETHERTYPE_IPV6) else None
+    if linktype == LINKTYPE_LINUX_SLL:
+        return start + 16
+    if linktype == LINKTYPE_LINUX_SLL2:
+        return start + 20
+    if linktype == LINKTYPE_NULL:
+        return start + 4
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return start
+    return None
+
+
+def udp_payload(linktype, data, start, end):
+    # (offset, length, destination port) of the UDP payload in a frame, or
+    # None if it is not an unfragmented UDP datagram
+    offset = ip_offset(linktype, data, start, end)
+    if offset is None or end < offset + 20:
+        return None
+    version = data[offset] >> 4
+    if version == 4:
+        header_length = (data[offset] & 0x0f) * 4
+        if data[offset + 9] != IPPROTO_UDP:
+            return None
+        if unpack_from('>H', data, offset + 6)[0] & 0x3fff:
+            return None  # fragment
+        offset += header_length
+    elif version == 6:
+        if data[offset + 6] != IPPROTO_UDP:
+            return None  # extension headers are not supported
+        offset += 40
+    else:
+        return None
+    if end < offset + 8:
+        return None
+    _, port, length, _ = UDP_HEADER.unpack_from(data, offset)
+    length = min(length - 8, end - offset - 8)
+    if length < 0:
+        return None
+    return offset + 8, length, port
+
+
+class PcapFile():
+    # UDP payloads of a pcap or pcapng capture, as zero-copy slices of the
+    # mapped file. Has the same packet interface as simulator.Capture.
+
+    def __init__(self, path, port=None):
+        self.file = io.open(path, 'rb')
+        # Copy-on-write, so that packets can be rewritten and handed to sendmmsg
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.view = memoryview(self.data)
+        self.port = port
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        self.times = array('d')  # capture time, seconds since the epoch
+        if len(self.data) >= 4 and unpack_from('<I', self.data)[0] == PCAPNG_SHB:
+            self._parse_pcapng()
+        else:
+            self._parse_pcap()
+
+    def _add(self, linktype, start, end, timestamp):
+        payload = udp_payload(linktype, self.data, start, end)
+        if payload is None:
+            return
+        offset, length, port = payload
+        if self.port is not None and port != self.port:
+            return
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.times.append(timestamp)
+
+    def _parse_pcap(self):
+        data = self.data
+        if len(data) < PCAP_HEADER.size:
+            raise ValueError('Not a pcap file')
+        magic = unpack_from('<I', data)[0]
+        order = '<'
+        if magic not in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            order = '>'
+            magic = unpack_from('>I', data)[0]
+            if magic not in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+                raise ValueError('Not a pcap or pcapng file')
+        scale = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+        linktype = unpack_from(order + 'I', data, 20)[0] & 0xffff
+        record = Struct(order + 'IIII')
+        position = PCAP_HEADER.size
+        size = len(data)
+        while position + record.size <= size:
+            seconds, fraction, captured, _ = record.unpack_from(data, position)
+            start = position + record.size
+            end = min(size, start + captured)
+            self._add(linktype, start, end, seconds + fraction * scale)
+            position = start + captured
+
+    def _parse_pcapng(self):
+        data = self.data
+        size = len(data)
+        order = '<'
+        interfaces = []  # (linktype, seconds per timestamp unit)
+        timestamp = 0.0
+        position = 0
+        while position + 12 <= size:
+            block_type = unpack_from(order + 'I', data, position)[0]
+            if block_type == PCAPNG_SHB:
+                # Each section sets its own byte order and interfaces
+                magic = unpack_from('<I', data, position + 8)[0]
+                order = '<' if magic == PCAPNG_BYTE_ORDER else '>'
+                interfaces = []
+            block_length = unpack_from(order + 'I', data, position + 4)[0]
+            if block_length < 12 or position + block_length > size:
+                break
+            body = position + 8
+            end = position + block_length - 4
+            if block_type == PCAPNG_IDB:
+                linktype = unpack_from(order + 'H', data, body)[0]
+                interfaces.append((linktype, self._resolution(order, body + 8, end)))
+            elif block_type == PCAPNG_EPB:
+                interface, high, low, captured, _ = unpack_from(order + 'IIIII', data, body)
+                linktype, resolution = interfaces[interface]
+                timestamp = ((high << 32) | low) * resolution
+                start = body + 20
+                self._add(linktype, start, min(end, start + captured), timestamp)
+            elif block_type == PCAPNG_SPB and interfaces:
+                # No timestamp of its own, keep the previous one
+                length = unpack_from(order + 'I', data, body)[0]
+                start = body + 4
+                self._add(interfaces[0][0], start, min(end, start + length), timestamp)
+            position += block_length
+
+    def _resolution(self, order, position, end):
+        # if_tsresol option of an interface description block
+        while position + 4 <= end:
+            code, length = unpack_from(order + 'HH', self.data, position)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                value = self.data[position + 4]
+                if value & 0x80:
+                    return 2.0 ** -(value & 0x7f)
+                return 10.0 ** -value
+            position += 4 + (length + 3) // 4 * 4
+        return 1e-6
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def packet(self, i):
+        offset = self.offsets[i]
+        return self.view[offset:offset + self.lengths[i]]
+
+    def close(self):
+        try:
+            self.view.release()
+            self.data.close()
+        except BufferError:
+            # Still exported, for example by the frames of an exception on
+            # its way up. The mapping goes when they are garbage collected.
+            pass
+        self.file.close()
+
+
+class PcapWriter():
+    # Writes UDP datagrams to a pcap file with raw IPv4 framing, so that
+    # they show up in Wireshark with their addresses and ports. Writing is
+    # done by a background thread; record() only copies the packets. If the
+    # writer falls behind, records are dropped and counted rather than
+    # blocking the caller.
+
+    def __init__(self, path, queue_size=1024):
+        self.file = io.open(path, 'wb', buffering=1 << 20)
+        self.file.write(PCAP_HEADER.pack(PCAP_MAGIC_NS, 2, 4, 0, 0, 65535, LINKTYPE_RAW))
+        self.queue = queue.Queue(queue_size)
+        self.written = 0
+        self.dropped = 0
+        self._headers = {}
+        self.thread = Thread(target=self._run, name='pcap-writer', daemon=True)
+        self.thread.start()
+
+    def record(self, packets, src, dst):
+        # src and dst are (host, port) tuples
+        try:
+            self.queue.put_nowait((time_ns(), src, dst, [bytes(packet) for packet in packets]))
+        except queue.Full:
+            self.dropped += len(packets)
+
+    def _header(self, src, dst, length):
+        # IPv4 and UDP headers, cached as they only depend on these values
+        key = (src, dst, length)
+        header = self._headers.get(key)
+        if header is None:
+            ip = bytearray(IPV4_HEADER.pack(0x45, 0, 28 + length, 0, 0x4000, 64, IPPROTO_UDP, 0,
+                                            socket.inet_aton(src[0]), socket.inet_aton(dst[0])))
+            checksum = sum(unpack_from('>10H', ip))
+            checksum = (checksum & 0xffff) + (checksum >> 16)
+            checksum = (checksum & 0xffff) + (checksum >> 16)
+            ip[10:12] = (~checksum & 0xffff).to_bytes(2, 'big')
+            header = bytes(ip) + UDP_HEADER.pack(src[1], dst[1], 8 + length, 0)
+            if len(self._headers) < 65536:
+                self._headers[key] = header
+        return header
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, src, dst, packets = item
+            seconds, nanoseconds = divmod(timestamp, 1000000000)
+            out = bytearray()
+            for packet in packets:
+                length = len(packet) + 28
+                out += PCAP_RECORD.pack(seconds, nanoseconds, length, length)
+                out += self._header(src, dst, len(packet))
+                out += packet
+            self.file.write(out)
+            self.written += len(packets)
+        self.file.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the UDP traffic in a pcap or pcapng capture')
+    parser.add_argument('file', help='pcap or pcapng capture')
+    parser.add_argument('--port', type=int, help='only count datagrams to this UDP port')
+    parser.add_argument('--extract', metavar='FILE',
+                        help='write the UDP payloads back to back to FILE, e.g. a .ccsds capture')
+    args = parser.parse_args()
+
+    pcap = PcapFile(args.file, args.port)
+    try:
+        if not len(pcap):
+            print('No UDP datagrams')
+        else:
+            duration = pcap.times[-1] - pcap.times[0]
+            print('{} UDP datagrams, {} bytes, over {:.3f} s'.format(
+                len(pcap), sum(pcap.lengths), duration))
+        if args.extract:
+            with io.open(args.extract, 'wb') as f:
+                for i in range(len(pcap)):
+                    f.write(pcap.packet(i))
+    finally:
+        pcap.close()
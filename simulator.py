@@ -1,79 +1,1692 @@
+import argparse
+import asyncio
 import binascii
+import ctypes
+import ctypes.util
+import errno
+import gzip
+import heapq
 import io
+import lzma
+import mmap
+import os
+import random
 import socket
 import sys
-from struct import unpack_from
-from threading import Thread
-from time import sleep
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import TimeoutError
+from struct import Struct, pack, unpack_from
+from threading import Event, Thread
+from time import monotonic
 
+from pcap import PcapFile, PcapWriter
 
-def send_tm(simulator):
-    tm_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-    with io.open('testdata.ccsds', 'rb') as f:
-        simulator.tm_counter = 1
-        header = bytearray(6)
-        while f.readinto(header) == 6:
-            (len,) = unpack_from('>H', header, 4)
+def index_packets(data):
+    # Offsets of each CCSDS packet in the buffer, plus a final entry
+    # marking the end of the last complete packet.
+    offsets = array('Q')
+    pos = 0
+    end = len(data)
+    while pos + 6 <= end:
+        (length,) = unpack_from('>H', data, pos + 4)
+        if pos + length + 7 > end:
+            break
+        offsets.append(pos)
+        pos += length + 7
+    offsets.append(pos)
+    return offsets
 
-            packet = bytearray(len + 7)
-            f.seek(-6, io.SEEK_CUR)
-            f.readinto(packet)
 
-            tm_socket.sendto(packet, ('127.0.0.1', 10015))
-            simulator.tm_counter += 1
+# Sidecar index file: header, then packet offsets (one more than the
+# number of packets) and the onboard time of each packet.
+INDEX_HEADER = Struct('<8sQQQ')  # magic, capture size, capture mtime (ns), packet count
+INDEX_MAGIC = b'CCSDSIX1'
 
-            sleep(1)
+# ElapsedSeconds and OrbitNumberCumulative in the Spacecraft container
+ELAPSED_SECONDS = Struct('>I')
+ELAPSED_SECONDS_OFFSET = 14
+ORBIT_NUMBER = Struct('>I')
+ORBIT_NUMBER_OFFSET = 10
+# Seconds per orbit in the included test data, for captures too short to
+# measure it
+ORBIT_PERIOD = 6059.4
 
 
-def receive_tc(simulator):
-    tc_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    tc_socket.bind(('127.0.0.1', 10025))
-    while True:
-        data, _ = tc_socket.recvfrom(4096)
-        simulator.last_tc = data
-        simulator.tc_counter += 1
+class PacketIndex():
 
+    def __init__(self, offsets, times):
+        self.offsets = offsets
+        self.times = times
+
+    def __len__(self):
+        return len(self.times)
+
+    def find(self, elapsed):
+        # First packet with an onboard time of at least 'elapsed' seconds.
+        # Assumes onboard time does not go backwards within the capture.
+        return bisect_left(self.times, elapsed)
+
+    def save(self, path, stat):
+        tmp_path = path + '.tmp'
+        with io.open(tmp_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(self)))
+            self.offsets.tofile(f)
+            self.times.tofile(f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path, stat):
+        # Returns None if the sidecar is missing or stale
+        try:
+            with io.open(path, 'rb') as f:
+                magic, size, mtime, count = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+                if magic != INDEX_MAGIC or size != stat.st_size or mtime != stat.st_mtime_ns:
+                    return None
+                offsets = array('Q')
+                offsets.fromfile(f, count + 1)
+                times = array('I')
+                times.fromfile(f, count)
+                return PacketIndex(offsets, times)
+        except (OSError, EOFError, ValueError):
+            return None
+
+
+def build_index(data):
+    # One pass over the capture. Packets too short to hold ElapsedSeconds
+    # inherit the time of the previous packet.
+    offsets = index_packets(data)
+    times = array('I')
+    elapsed = 0
+    for i in range(len(offsets) - 1):
+        if offsets[i + 1] - offsets[i] >= ELAPSED_SECONDS_OFFSET + 4:
+            (elapsed,) = ELAPSED_SECONDS.unpack_from(data, offsets[i] + ELAPSED_SECONDS_OFFSET)
+        times.append(elapsed)
+    return PacketIndex(offsets, times)
+
+
+def load_index(path, data):
+    # Reuses <path>.idx while the capture's size and mtime are unchanged
+    stat = os.stat(path)
+    index_path = path + '.idx'
+    index = PacketIndex.load(index_path, stat)
+    if index is None:
+        index = build_index(data)
+        try:
+            index.save(index_path, stat)
+        except OSError:
+            pass  # Read-only location, keep the index in memory only
+    return index
+
+
+def parse_elapsed(value):
+    # Onboard time in seconds, given as seconds or as [D:]HH:MM[:SS]
+    if ':' not in value:
+        return int(value)
+    parts = [int(p) for p in value.split(':')]
+    if len(parts) == 2:
+        parts.append(0)
+    seconds = parts[-3] * 3600 + parts[-2] * 60 + parts[-1]
+    if len(parts) == 4:
+        seconds += parts[0] * 86400
+    return seconds
+
+
+class Capture():
+
+    def __init__(self, path):
+        self.file = io.open(path, 'rb')
+        # Copy-on-write mapping: the file is never modified, but the buffer
+        # is writable so that its address can be handed to sendmmsg.
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.index = load_index(path, self.data)
+        self.offsets = self.index.offsets
+        self.view = memoryview(self.data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def packet(self, i):
+        # Zero-copy slice of the mapped file
+        return self.view[self.offsets[i]:self.offsets[i + 1]]
+
+    def close(self):
+        try:
+            self.view.release()
+            self.data.close()
+        except BufferError:
+            # Still exported, for example by the frames of an exception on
+            # its way up. The mapping goes when they are garbage collected.
+            pass
+        self.file.close()
+
+
+class CaptureReader():
+    # Sequential packets of a (possibly shared) mapped capture, optionally
+    # limited to a range of onboard time. When looping, 'wraps' counts the
+    # completed passes and a batch never spans two passes.
+
+    def __init__(self, capture, owned=False, start=None, stop=None, loop=False):
+        self.capture = capture
+        self.owned = owned
+        self.first = 0 if start is None else capture.index.find(start)
+        self.end = len(capture) if stop is None else capture.index.find(stop)
+        self.position = self.first
+        self.loop = loop
+        self.wraps = 0
+        if loop and self.end > self.first:
+            # How much onboard time advances per pass, and the orbit number
+            # at any onboard time
+            times = capture.index.times
+            self.elapsed_span = times[self.end - 1] - times[self.first] + 1
+            self.orbits = OrbitModel(capture)
+
+    async def take(self, count):
+        if self.position >= self.end and self.loop and self.end > self.first:
+            self.position = self.first
+            self.wraps += 1
+        end = min(self.end, self.position + count)
+        packets = [self.capture.packet(i) for i in range(self.position, end)]
+        self.position = end
+        return packets
+
+    def close(self):
+        if self.owned:
+            self.capture.close()
+
+
+COMPRESSED_SUFFIXES = ('.gz', '.xz', '.lzma', '.zst')
+
+
+def open_compressed(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith(('.xz', '.lzma')):
+        return lzma.open(path, 'rb')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError('Reading .zst captures requires the zstandard package')
+        return zstandard.ZstdDecompressor().stream_reader(io.open(path, 'rb'), closefd=True)
+    raise ValueError('Unsupported compression: {}'.format(path))
+
+
+class StreamReader():
+    # Packets of a compressed capture. A background thread decompresses
+    # blocks into a bounded queue, so memory stays flat whatever the size
+    # of the capture, and the sender only waits if the queue runs dry.
+
+    def __init__(self, path, loop, depth=64, block_size=256 * 1024):
+        self.queue = asyncio.Queue(maxsize=depth)
+        self.pending = deque()
+        self.done = False
+        self.stopped = Event()
+        self.thread = Thread(target=self._produce, args=(path, loop, block_size))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _produce(self, path, loop, block_size):
+        try:
+            with open_compressed(path) as f:
+                rest = b''
+                while not self.stopped.is_set():
+                    data = f.read(block_size)
+                    if not data:
+                        break
+                    block = bytearray(rest)
+                    block += data
+                    offsets = index_packets(block)
+                    view = memoryview(block)
+                    packets = [view[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+                    rest = bytes(view[offsets[-1]:])
+                    if packets:
+                        self._put(packets, loop)
+        finally:
+            self._put(None, loop)
+
+    def _put(self, item, loop):
+        try:
+            future = asyncio.run_coroutine_threadsafe(self.queue.put(item), loop)
+        except RuntimeError:  # Loop is closed
+            return
+        while not self.stopped.is_set():
+            try:
+                future.result(timeout=0.5)
+                return
+            except TimeoutError:
+                pass
+        future.cancel()
+
+    async def take(self, count):
+        while not self.pending and not self.done:
+            packets = await self.queue.get()
+            if packets is None:
+                self.done = True
+            else:
+                self.pending.extend(packets)
+        pending = self.pending
+        return [pending.popleft() for _ in range(min(count, len(pending)))]
+
+    def close(self):
+        self.stopped.set()
+
+
+PCAP_SUFFIXES = ('.pcap', '.pcapng', '.cap')
+
+
+def open_reader(simulator):
+    start, stop, loop = simulator.start_time, simulator.stop_time, simulator.loop
+    if simulator.capture:
+        return CaptureReader(simulator.capture, start=start, stop=stop, loop=loop)
+    if simulator.tm_file.endswith(PCAP_SUFFIXES):
+        if start is not None or stop is not None or loop:
+            raise ValueError('Packet captures cannot be looped or replayed from a given time')
+        return CaptureReader(PcapFile(simulator.tm_file, simulator.pcap_port), owned=True)
+    if simulator.tm_file.endswith(COMPRESSED_SUFFIXES):
+        if start is not None or stop is not None or loop:
+            raise ValueError('Compressed captures cannot be looped or replayed from a given time')
+        return StreamReader(simulator.tm_file, asyncio.get_running_loop())
+    return CaptureReader(Capture(simulator.tm_file), owned=True, start=start, stop=stop, loop=loop)
+
+
+class Pacer():
+
+    def __init__(self, interval=1.0, speed=1.0):
+        # A speed of 0 (or less) disables pacing altogether
+        self.period = interval / speed if speed > 0 else 0
+        self.start = None
+        self.count = 0
+        self.last_lateness = 0
+        self.max_lateness = 0
+
+    async def wait(self, limit=1):
+        # Deadlines are derived from the start time rather than from the
+        # previous send, so that time spent sending does not add up as drift.
+        # Returns how many packets are due, up to limit.
+        if not self.period:
+            # Still yield, so that other streams on the loop get a turn
+            await asyncio.sleep(0)
+            self.count += limit
+            return limit
+        now = monotonic()
+        if self.start is None:
+            self.start = now
+        deadline = self.start + self.count * self.period
+        if deadline > now:
+            await asyncio.sleep(deadline - now)
+            now = monotonic()
+        due = int((now - self.start) / self.period) - self.count + 1
+        count = max(1, min(limit, due))
+        self.count += count
+
+        lateness = now - deadline
+        self.last_lateness = lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        return count
+
+    def rate(self):
+        # Packets per second, None when unpaced
+        return 1 / self.period if self.period else None
+
+
+class ReplayPacer(Pacer):
+    # Paces packets at their original capture times, scaled by speed
+
+    def __init__(self, times, speed=1.0):
+        super().__init__(speed=speed)
+        # Capture times can step back slightly, keep them monotonic
+        self.times = array('d', times)
+        for i in range(1, len(self.times)):
+            if self.times[i] < self.times[i - 1]:
+                self.times[i] = self.times[i - 1]
+
+    async def wait(self, limit=1):
+        times = self.times
+        if not self.period:
+            return await super().wait(limit)
+        if self.count >= len(times):
+            # Past the last recorded time, let the reader report the end
+            await asyncio.sleep(0)
+            return limit
+        now = monotonic()
+        if self.start is None:
+            self.start = now
+        deadline = self.start + (times[self.count] - times[0]) * self.period
+        if deadline > now:
+            await asyncio.sleep(deadline - now)
+            now = monotonic()
+        due = bisect_right(times, times[0] + (now - self.start) / self.period, self.count) - self.count
+        count = max(1, min(limit, due))
+        self.count += count
+
+        lateness = now - deadline
+        self.last_lateness = lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        return count
+
+    def rate(self):
+        duration = self.times[-1] - self.times[0] if self.times else 0
+        if not self.period or not duration:
+            return None
+        return len(self.times) / duration / self.period
+
+
+class Sender():
+
+    def __init__(self, transport, address, batch=1):
+        self.transport = transport
+        self.address = address
+        self.batch = batch
+        self.datagrams = 0
+        self.syscalls = 0
+
+    def send(self, packets):
+        for packet in packets:
+            self.transport.sendto(packet, self.address)
+        self.datagrams += len(packets)
+        self.syscalls += len(packets)
 
-class Simulator():
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def load_sendmmsg():
+    if not sys.platform.startswith('linux'):
+        return None
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    try:
+        sendmmsg = libc.sendmmsg
+    except AttributeError:
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = load_sendmmsg()
+
+
+class MmsgSender(Sender):
+    # Sends up to 'batch' datagrams per syscall using Linux sendmmsg(2)
+
+    def __init__(self, transport, address, batch):
+        super().__init__(transport, address, batch)
+        self.fd = transport.get_extra_info('socket').fileno()
+        if isinstance(address, str):
+            # Unix socket path
+            self.sockaddr = ctypes.create_string_buffer(
+                pack('=H', socket.AF_UNIX) + os.fsencode(address), 2 + len(os.fsencode(address)) + 1)
+        else:
+            host, port = address
+            self.sockaddr = ctypes.create_string_buffer(
+                pack('=H', socket.AF_INET) + pack('>H', port) + socket.inet_aton(host) + bytes(8))
+        self.iovecs = (iovec * batch)()
+        self.msgs = (mmsghdr * batch)()
+        for i in range(batch):
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.sockaddr)
+            hdr.msg_namelen = len(self.sockaddr)
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+        # Points the iovec of empty datagrams somewhere, from_buffer needs a byte
+        self.empty = ctypes.c_char()
+
+    def send(self, packets):
+        if len(packets) > self.batch:
+            # Impairments can add packets to a batch
+            for i in range(0, len(packets), self.batch):
+                self.send(packets[i:i + self.batch])
+            return
+        if self.transport.get_write_buffer_size():
+            # Let the transport drain its backlog first, to keep packet order
+            super().send(packets)
+            return
+
+        # The ctypes views pin the packet buffers until the syscall has returned
+        buffers = [ctypes.c_char.from_buffer(packet) if len(packet) else self.empty for packet in packets]
+        for i, buf in enumerate(buffers):
+            self.iovecs[i].iov_base = ctypes.addressof(buf)
+            self.iovecs[i].iov_len = len(packets[i])
+
+        sent = failed = 0
+        while sent < len(packets):
+            msgs = ctypes.addressof(self.msgs) + sent * ctypes.sizeof(mmsghdr)
+            n = _sendmmsg(self.fd, msgs, len(packets) - sent, 0)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # Socket buffer is full, the transport queues the rest
+                    super().send(packets[sent:])
+                    break
+                # Like the transport's sendto: report the error, skip the
+                # datagram and carry on with the rest
+                self.transport.get_protocol().error_received(OSError(err, os.strerror(err)))
+                n = 1
+                failed += 1
+            sent += n
+            self.syscalls += 1
+        self.datagrams += sent - failed
+
+
+def create_sender(transport, address, batch):
+    if batch > 1 and _sendmmsg is not None:
+        return MmsgSender(transport, address, batch)
+    return Sender(transport, address, batch)
+
+
+class Histogram():
+    # Fixed buckets, so that an observation is one bisect and two additions
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def expose(self, name, description):
+        lines = ['# HELP {} {}'.format(name, description), '# TYPE {} histogram'.format(name)]
+        cumulative = 0
+        for bound, count in zip(self.bounds + [None], self.counts):
+            cumulative += count
+            le = '+Inf' if bound is None else repr(bound)
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, le, cumulative))
+        lines.append('{}_sum {}'.format(name, self.sum))
+        lines.append('{}_count {}'.format(name, cumulative))
+        return lines
+
+
+TIME_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0]
+
+
+class Metrics():
+    # Plain counters, only touched from the event loop thread. Rates are
+    # computed by snapshot() over the interval since the previous call.
 
     def __init__(self):
+        self.tm_packets = 0
+        self.tm_bytes = 0
+        self.tc_commands = 0
+        self.tc_bytes = 0
+        self.tm_dump_packets = 0
+        self.tm_dump_bytes = 0
+        self.tm_errors = 0
+        self.last_tm_error = None
+        self.lateness = Histogram(TIME_BUCKETS)
+        self.tc_interarrival = Histogram(TIME_BUCKETS)
+        self.last_tc_time = None
+        self.kernel_drops = {}  # port to packets dropped by the kernel
+        self.rates = {}
+        self._prev = None
+
+    def tc_received(self, data):
+        now = monotonic()
+        if self.last_tc_time is not None:
+            self.tc_interarrival.observe(now - self.last_tc_time)
+        self.last_tc_time = now
+        self.tc_commands += 1
+        self.tc_bytes += len(data)
+
+    def snapshot(self):
+        now = monotonic()
+        totals = (self.tm_packets, self.tm_bytes, self.tc_commands)
+        if self._prev:
+            prev_time, prev_totals = self._prev
+            elapsed = now - prev_time
+            names = ('tm_packets', 'tm_bytes', 'tc_commands')
+            self.rates = {name: (total - prev) / elapsed
+                          for name, total, prev in zip(names, totals, prev_totals)}
+        self._prev = (now, totals)
+
+    def expose(self):
+        lines = []
+        for name, value, kind, description in (
+                ('simulator_tm_packets_total', self.tm_packets, 'counter', 'TM packets sent'),
+                ('simulator_tm_bytes_total', self.tm_bytes, 'counter', 'TM bytes sent'),
+                ('simulator_tc_commands_total', self.tc_commands, 'counter', 'TC packets received'),
+                ('simulator_tc_bytes_total', self.tc_bytes, 'counter', 'TC bytes received'),
+                ('simulator_tm_dump_packets_total', self.tm_dump_packets, 'counter',
+                 'Recorded TM packets dumped during passes'),
+                ('simulator_tm_dump_bytes_total', self.tm_dump_bytes, 'counter',
+                 'Recorded TM bytes dumped during passes'),
+                ('simulator_tm_send_errors_total', self.tm_errors, 'counter', 'TM datagrams that failed to send'),
+                ('simulator_tm_packets_per_second', self.rates.get('tm_packets', 0), 'gauge',
+                 'TM packet rate over the last interval'),
+                ('simulator_tm_bytes_per_second', self.rates.get('tm_bytes', 0), 'gauge',
+                 'TM byte rate over the last interval'),
+                ('simulator_tc_commands_per_second', self.rates.get('tc_commands', 0), 'gauge',
+                 'TC rate over the last interval')):
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{} {}'.format(name, value))
+        if self.kernel_drops:
+            name = 'simulator_kernel_udp_drops_total'
+            lines.append('# HELP {} UDP packets dropped by the kernel on the receiving socket'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            for port, drops in sorted(self.kernel_drops.items()):
+                lines.append('{}{{port="{}"}} {}'.format(name, port, drops))
+        lines += self.lateness.expose('simulator_tm_send_lateness_seconds',
+                                      'Delay of TM sends against their deadline')
+        lines += self.tc_interarrival.expose('simulator_tc_interarrival_seconds',
+                                             'Time between received TC packets')
+        return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(simulator, port=None, path=None, interval=10.0):
+    # Serves metrics in Prometheus text format on localhost:port, and/or
+    # rewrites them to 'path' every interval.
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = simulator.metrics.expose().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = None
+    if port:
+        server = await asyncio.start_server(handle, '127.0.0.1', port)
+    try:
+        while True:
+            simulator.metrics.snapshot()
+            if path:
+                tmp_path = path + '.tmp'
+                with io.open(tmp_path, 'w') as f:
+                    f.write(simulator.metrics.expose())
+                os.replace(tmp_path, path)
+            await asyncio.sleep(interval)
+    finally:
+        if server:
+            server.close()
+
+
+# Socket buffers hold this much traffic at the target rate
+BUFFER_TIME = 0.25
+MIN_BUFFER = 256 * 1024
+MAX_BUFFER = 16 * 1024 * 1024
+
+
+def size_socket_buffer(sock, option, rate):
+    # Sizes SO_SNDBUF or SO_RCVBUF for a rate in bytes per second (None for
+    # as fast as possible). Returns the requested and the granted size, the
+    # kernel caps it at net.core.wmem_max or rmem_max.
+    size = MAX_BUFFER if rate is None else int(min(MAX_BUFFER, max(MIN_BUFFER, rate * BUFFER_TIME)))
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+    except OSError:
+        pass
+    granted = sock.getsockopt(socket.SOL_SOCKET, option)
+    if sys.platform.startswith('linux'):
+        # Linux reports twice the size, to account for its bookkeeping
+        granted //= 2
+    return size, granted
+
+
+def read_udp_sockets(ports, paths=('/proc/net/udp', '/proc/net/udp6')):
+    # Receive queue (bytes) and drop count of the local UDP sockets bound to
+    # the given ports, summed per port
+    stats = {}
+    for path in paths:
+        try:
+            with io.open(path) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            port = int(fields[1].rsplit(':', 1)[1], 16)
+            if port in ports:
+                rx_queue = int(fields[4].split(':')[1], 16)
+                queue, drops = stats.get(port, (0, 0))
+                stats[port] = (queue + rx_queue, drops + int(fields[-1]))
+    return stats
+
+
+def read_udp_counters(path='/proc/net/snmp'):
+    # System-wide UDP counters, e.g. RcvbufErrors and SndbufErrors
+    try:
+        with io.open(path) as f:
+            lines = [line.split() for line in f if line.startswith('Udp:')]
+    except OSError:
+        return {}
+    if len(lines) < 2:
+        return {}
+    return dict(zip(lines[0][1:], map(int, lines[1][1:])))
+
+
+class KernelDrops():
+    # Samples the kernel's UDP drop counters, relative to when we started.
+    # Drops on the TM port mean that Yamcs does not keep up, not that the
+    # packets were lost on the way.
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.available = os.path.exists('/proc/net/udp')
+        self.drops = {}
+        self.queued = {}
+        self.errors = {}
+        self._base_drops = {}
+        self._base_counters = read_udp_counters()
+
+    def sample(self):
+        if not self.available:
+            return
+        for port, (queue, drops) in read_udp_sockets(self.ports).items():
+            # The receiving socket may be replaced (e.g. Yamcs restarts),
+            # which resets its count
+            base = self._base_drops.setdefault(port, drops)
+            if drops < base:
+                self._base_drops[port] = base = 0
+            self.drops[port] = drops - base
+            self.queued[port] = queue
+        counters = read_udp_counters()
+        self.errors = {name: counters[name] - self._base_counters.get(name, 0)
+                       for name in ('RcvbufErrors', 'SndbufErrors') if name in counters}
+
+    def status(self):
+        if not self.available:
+            return 'unavailable'
+        parts = []
+        for port in self.ports:
+            if port in self.drops:
+                parts.append('{} dropped {} ({} B queued)'.format(
+                    port, self.drops[port], self.queued[port]))
+            else:
+                parts.append('{} not bound'.format(port))
+        parts += ['{} {}'.format(count, name) for name, count in self.errors.items()]
+        return ', '.join(parts)
+
+
+PASS, DROP, CORRUPT, REORDER, DUPLICATE = range(5)
+ACTION_NAMES = ['pass', 'drop', 'corrupt', 'reorder', 'duplicate']
+
+
+class Impairment():
+    # Seeded link impairments. Decisions are drawn a block at a time, so
+    # the same seed and settings always impair the same packets. Every
+    # change is logged with the packet's APID and sequence count.
+
+    BLOCK = 4096
+
+    def __init__(self, name, seed=0, loss=0.0, burst_enter=0.0, burst_exit=1.0, burst_loss=1.0,
+                 duplicate=0.0, reorder=0.0, window=4, corrupt=0.0, log=None):
+        self.name = name
+        self.rng = random.Random(seed)
+        self.loss = loss
+        # Gilbert-Elliott model: transition probabilities into and out of
+        # the bad state, and the loss probability while in it
+        self.burst_enter = burst_enter
+        self.burst_exit = burst_exit
+        self.burst_loss = burst_loss
+        self.bad = False
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.window = window
+        self.corrupt = corrupt
+        self.log = log
+        self.index = 0
+        self.actions = array('B')
+        self.params = array('I')
+        self.position = 0
+        self.held = []  # heap of (release index, packet index, packet)
+        self.counts = [0] * len(ACTION_NAMES)
+
+    def _fill(self):
+        rng = self.rng
+        actions = array('B', bytes(self.BLOCK))
+        params = array('I', bytes(4 * self.BLOCK))
+        corrupt_limit = self.corrupt
+        reorder_limit = corrupt_limit + self.reorder
+        duplicate_limit = reorder_limit + self.duplicate
+        for i in range(self.BLOCK):
+            if self.burst_enter:
+                if self.bad:
+                    self.bad = rng.random() >= self.burst_exit
+                else:
+                    self.bad = rng.random() < self.burst_enter
+            if rng.random() < (self.burst_loss if self.bad else self.loss):
+                actions[i] = DROP
+                continue
+            r = rng.random()
+            if r < corrupt_limit:
+                actions[i] = CORRUPT
+                params[i] = rng.getrandbits(32)
+            elif r < reorder_limit:
+                actions[i] = REORDER
+                params[i] = rng.randint(1, self.window)
+            elif r < duplicate_limit:
+                actions[i] = DUPLICATE
+        self.actions = actions
+        self.params = params
+        self.position = 0
+
+    def _record(self, index, action, packet, detail=''):
+        self.counts[action] += 1
+        if self.log:
+            apid = ((packet[0] & 0x07) << 8) | packet[1] if len(packet) >= 6 else -1
+            seq = sequence_count(packet) if len(packet) >= 6 else -1
+            self.log.write('{} {} {} apid={} seq={}{}\n'.format(
+                self.name, index, ACTION_NAMES[action], apid, seq, detail))
+
+    def apply(self, packets):
+        out = []
+        held = self.held
+        for packet in packets:
+            if self.position == len(self.actions):
+                self._fill()
+            action = self.actions[self.position]
+            param = self.params[self.position]
+            self.position += 1
+            index = self.index
+            self.index += 1
+
+            if action == PASS or (action == CORRUPT and not packet):
+                # Empty datagrams have no bit to flip
+                out.append(packet)
+            elif action == DROP:
+                self._record(index, action, packet)
+            elif action == DUPLICATE:
+                self._record(index, action, packet)
+                out.append(packet)
+                out.append(packet)
+            elif action == REORDER:
+                # Held packets are copied, the source buffer may be reused
+                self._record(index, action, packet, ' by={}'.format(param))
+                heapq.heappush(held, (index + param, index, bytearray(packet)))
+            elif action == CORRUPT:
+                bit = param % (len(packet) * 8)
+                self._record(index, action, packet, ' bit={}'.format(bit))
+                packet = bytearray(packet)
+                packet[bit // 8] ^= 0x80 >> (bit % 8)
+                out.append(packet)
+
+            while held and held[0][0] <= index:
+                out.append(heapq.heappop(held)[2])
+        return out
+
+    def flush(self):
+        out = [item[2] for item in sorted(self.held)]
+        self.held = []
+        return out
+
+    def status(self):
+        return ', '.join('{} {}'.format(self.counts[action], ACTION_NAMES[action])
+                         for action in (DROP, DUPLICATE, REORDER, CORRUPT))
+
+
+def parse_impairment(spec):
+    # 'loss=0.01,burst=0.001:0.1,dup=0.001,reorder=0.01:8,corrupt=1e-5'
+    options = {}
+    for item in spec.split(','):
+        key, _, value = item.partition('=')
+        key = key.strip()
+        if key == 'loss':
+            options['loss'] = float(value)
+        elif key == 'burst':
+            values = [float(v) for v in value.split(':')]
+            options['burst_enter'] = values[0]
+            if len(values) > 1:
+                options['burst_exit'] = values[1]
+            if len(values) > 2:
+                options['burst_loss'] = values[2]
+        elif key == 'dup':
+            options['duplicate'] = float(value)
+        elif key == 'reorder':
+            probability, _, window = value.partition(':')
+            options['reorder'] = float(probability)
+            if window:
+                options['window'] = int(window)
+        elif key == 'corrupt':
+            options['corrupt'] = float(value)
+        else:
+            raise argparse.ArgumentTypeError('Unknown impairment: {}'.format(key))
+    return options
+
+
+class LinkModel():
+    # One-way link with propagation delay, jitter and a bandwidth cap.
+    # Packets wait in a heap keyed on arrival time, so that many packets in
+    # flight cost O(log n) each. Arrivals never overtake each other, as on a
+    # real space link; use Impairment to reorder.
+
+    def __init__(self, delay=0.0, jitter=0.0, bandwidth=None, limit=100000, seed=0):
+        self.delay = delay
+        self.jitter = jitter
+        self.bandwidth = bandwidth  # bit/s
+        self.limit = limit
+        self.rng = random.Random(seed)
+        self.heap = []
+        self.counter = 0
+        self.busy_until = 0.0
+        self.last_arrival = 0.0
+        self.pending = asyncio.Event()
+        self.room = asyncio.Event()
+        self.room.set()
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def put(self, packets):
+        now = monotonic()
+        heap = self.heap
+        for packet in packets:
+            arrival = now
+            if self.bandwidth:
+                # Packets are serialized one after the other onto the link
+                arrival = self.busy_until = max(now, self.busy_until) + len(packet) * 8 / self.bandwidth
+            arrival += self.delay
+            if self.jitter:
+                arrival += self.rng.uniform(0, self.jitter)
+            if arrival < self.last_arrival:
+                arrival = self.last_arrival
+            self.last_arrival = arrival
+            heapq.heappush(heap, (arrival, self.counter, packet))
+            self.counter += 1
+        if len(heap) >= self.limit:
+            self.room.clear()
+        if heap:
+            self.idle.clear()
+            self.pending.set()
+
+    async def run(self, deliver):
+        # Calls deliver() with the list of packets that have arrived
+        heap = self.heap
+        while True:
+            if not heap:
+                self.pending.clear()
+                self.idle.set()
+                await self.pending.wait()
+                continue
+            wait = heap[0][0] - monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            now = monotonic()
+            arrived = []
+            while heap and heap[0][0] <= now:
+                arrived.append(heapq.heappop(heap)[2])
+            deliver(arrived)
+            if len(heap) < self.limit:
+                self.room.set()
+
+    def status(self):
+        return '{} in flight'.format(len(self.heap))
+
+
+def parse_link(spec):
+    # 'delay=0.25,jitter=0.01,rate=64000,queue=10000'
+    options = {}
+    for item in spec.split(','):
+        key, _, value = item.partition('=')
+        key = key.strip()
+        if key == 'delay':
+            options['delay'] = float(value)
+        elif key == 'jitter':
+            options['jitter'] = float(value)
+        elif key == 'rate':
+            options['bandwidth'] = float(value)
+        elif key == 'queue':
+            options['limit'] = int(value)
+        else:
+            raise argparse.ArgumentTypeError('Unknown link parameter: {}'.format(key))
+    return options
+
+
+# Byte offsets of the contact flags in the Spacecraft container
+CONTACT_OFFSETS = (107, 108)  # Contact_Golbasi_GS, Contact_Svalbard
+
+
+class PassModel():
+    # Store-and-forward through ground station passes. Packets are sent in
+    # realtime only while a contact flag is set. Outside a pass they are
+    # recorded onboard, and dumped at a high rate during the next pass.
+
+    def __init__(self, dump_rate=1000.0, capacity=None):
+        self.dump_rate = dump_rate
+        self.recorder = deque(maxlen=capacity)
+        self.contact = False
+        self.in_pass = asyncio.Event()
+        self.out_of_pass = asyncio.Event()
+        self.out_of_pass.set()
+        self.passes = 0
+        self.recorded = 0
+        self.overwritten = 0
+        self.dumped = 0
+
+    def split(self, packets):
+        # Returns the packets to send in realtime, records the others
+        realtime = []
+        recorder = self.recorder
+        for packet in packets:
+            if len(packet) > CONTACT_OFFSETS[-1]:
+                contact = any(packet[offset] for offset in CONTACT_OFFSETS)
+                if contact != self.contact:
+                    self.contact = contact
+                    if contact:
+                        self.passes += 1
+                        self.in_pass.set()
+                        self.out_of_pass.clear()
+                    else:
+                        self.in_pass.clear()
+                        self.out_of_pass.set()
+            if self.contact:
+                realtime.append(packet)
+            else:
+                if len(recorder) == recorder.maxlen:
+                    self.overwritten += 1
+                # Copied, the packet is rewritten or reused before the dump
+                recorder.append(bytearray(packet))
+                self.recorded += 1
+        return realtime
+
+    def take(self, count):
+        recorder = self.recorder
+        return [recorder.popleft() for _ in range(min(count, len(recorder)))]
+
+    def status(self):
+        return '{} passes, {} recorded, {} dumped'.format(self.passes, self.recorded, self.dumped)
+
+
+async def dump_tm(simulator, passes):
+    loop = asyncio.get_running_loop()
+    dump_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dump_socket.setblocking(False)
+    size_socket_buffer(dump_socket, socket.SO_SNDBUF, passes.dump_rate * 1024)
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: TmProtocol(simulator.metrics), sock=dump_socket)
+    try:
+        sender = create_sender(transport, simulator.dump_address, simulator.batch)
+        while True:
+            await passes.in_pass.wait()
+            # Paced from the start of each pass, so that idle time between
+            # passes does not turn into a catch-up burst
+            pacer = Pacer(speed=passes.dump_rate)
+            while passes.in_pass.is_set() and passes.recorder:
+                count = await pacer.wait(sender.batch)
+                packets = passes.take(count)
+                if packets:
+                    await protocol.writable.wait()
+                    sender.send(packets)
+                    passes.dumped += len(packets)
+                    simulator.metrics.tm_dump_packets += len(packets)
+                    simulator.metrics.tm_dump_bytes += sum(map(len, packets))
+            # Nothing is recorded during a pass, wait for it to end
+            await passes.out_of_pass.wait()
+    finally:
+        transport.close()
+
+
+# Largest UDP payload over IPv4
+MAX_DATAGRAM = 65507
+
+
+def parse_pack(value):
+    size = int(value)
+    if not 0 < size <= MAX_DATAGRAM:
+        raise argparse.ArgumentTypeError('Datagram size must be between 1 and {} bytes'.format(MAX_DATAGRAM))
+    return size
+
+
+def pack_datagrams(packets, size):
+    # Groups consecutive packets into datagrams of at most 'size' bytes. A
+    # larger packet goes out on its own. The receiver splits them again
+    # using the CCSDS length field.
+    datagrams = []
+    group = []
+    length = 0
+    for packet in packets:
+        if group and length + len(packet) > size:
+            datagrams.append(bytearray().join(group))
+            group = []
+            length = 0
+        group.append(packet)
+        length += len(packet)
+    if group:
+        datagrams.append(bytearray().join(group))
+    return datagrams
+
+
+def sequence_count(packet):
+    return ((packet[2] & 0x3F) << 8) | packet[3]
+
+
+def orbit_number(packet):
+    return ORBIT_NUMBER.unpack_from(packet, ORBIT_NUMBER_OFFSET)[0]
+
+
+class OrbitModel():
+    # Orbit number as a function of onboard time, fitted to the orbit number
+    # changes of a capture, so that looped passes carry on from the orbit
+    # phase rather than repeat the capture's own numbers
+
+    def __init__(self, capture):
+        end = len(capture)
+        first_orbit = orbit_number(capture.packet(0))
+        last_orbit = orbit_number(capture.packet(end - 1))
+
+        def start_of(orbit):
+            # Orbit numbers only go up, so a binary search finds the change
+            low, high = 0, end - 1
+            while low < high:
+                middle = (low + high) // 2
+                if orbit_number(capture.packet(middle)) < orbit:
+                    low = middle + 1
+                else:
+                    high = middle
+            return low
+
+        times = capture.index.times
+        self.period = ORBIT_PERIOD
+        if last_orbit > first_orbit:
+            self.orbit = first_orbit + 1
+            self.start = times[start_of(self.orbit)]
+            if last_orbit - first_orbit >= 2:
+                self.period = (times[start_of(last_orbit)] - self.start) / (last_orbit - self.orbit)
+        else:
+            # No change to fit to, take the capture as starting an orbit
+            self.orbit = first_orbit
+            self.start = times[0]
+
+    def orbit_at(self, elapsed):
+        return self.orbit + int((elapsed - self.start) // self.period)
+
+    def offsets(self, packets, elapsed):
+        # Per packet, what to add to OrbitNumberCumulative when elapsed is
+        # added to ElapsedSeconds
+        offsets = []
+        for packet in packets:
+            if len(packet) >= ELAPSED_SECONDS_OFFSET + 4:
+                (value,) = ELAPSED_SECONDS.unpack_from(packet, ELAPSED_SECONDS_OFFSET)
+                offsets.append(self.orbit_at(value + elapsed) - orbit_number(packet))
+            else:
+                offsets.append(0)
+        return offsets
+
+
+def rewrite_headers(packets, apid, seq):
+    # Overwrites the 14-bit sequence count, and the APID unless None, in
+    # place and returns the next sequence count. Packets are sent before
+    # the next rewrite, so several streams can share one capture.
+    for packet in packets:
+        if apid is not None:
+            packet[0] = (packet[0] & 0xF8) | (apid >> 8)
+            packet[1] = apid & 0xFF
+        packet[2] = (packet[2] & 0xC0) | (seq >> 8)
+        packet[3] = seq & 0xFF
+        seq = (seq + 1) & 0x3FFF
+    return seq
+
+
+def shift_onboard_time(packets, elapsed, orbits):
+    # Adds to ElapsedSeconds, and one value of orbits per packet to
+    # OrbitNumberCumulative, in place. Applied with negated values after
+    # sending, to leave the capture untouched.
+    for packet, orbits in zip(packets, orbits):
+        if len(packet) >= ELAPSED_SECONDS_OFFSET + 4:
+            (value,) = ELAPSED_SECONDS.unpack_from(packet, ELAPSED_SECONDS_OFFSET)
+            ELAPSED_SECONDS.pack_into(packet, ELAPSED_SECONDS_OFFSET, (value + elapsed) & 0xFFFFFFFF)
+            (value,) = ORBIT_NUMBER.unpack_from(packet, ORBIT_NUMBER_OFFSET)
+            ORBIT_NUMBER.pack_into(packet, ORBIT_NUMBER_OFFSET, (value + orbits) & 0xFFFFFFFF)
+
+
+class TmProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def error_received(self, exc):
+        # Failed sends, such as no listener on a Unix socket or an oversized
+        # datagram. The datagram is lost, sending goes on.
+        if self.metrics:
+            self.metrics.tm_errors += 1
+            self.metrics.last_tm_error = exc
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+
+class StreamClients():
+    # Consumers connected to the TM stream server (TCP or Unix). Writes go
+    # to all of them; 'writable' is cleared while any of them is paused, or
+    # while there is none, so that the replay waits for the next one.
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.server = None
+        self.transports = set()
+        self.paused = set()
+        self.connected = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.buffer = None
+
+    def add(self, transport):
+        sock = transport.get_extra_info('socket')
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            # Writes are already coalesced per batch, do not hold them back
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = size_socket_buffer(sock, socket.SO_SNDBUF, self.rate)
+        self.transports.add(transport)
+        self.connected.set()
+        if not self.paused:
+            self.writable.set()
+
+    def remove(self, transport):
+        self.transports.discard(transport)
+        self.resume(transport)
+        if not self.transports:
+            self.connected.clear()
+            self.writable.clear()
+
+    def pause(self, transport):
+        self.paused.add(transport)
+        self.writable.clear()
+
+    def resume(self, transport):
+        self.paused.discard(transport)
+        if not self.paused and self.transports:
+            self.writable.set()
+
+    def close(self):
+        if self.server:
+            self.server.close()
+        for transport in list(self.transports):
+            transport.close()
+
+
+class StreamProtocol(asyncio.Protocol):
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.clients.add(transport)
+
+    def connection_lost(self, exc):
+        self.clients.remove(self.transport)
+
+    def pause_writing(self):
+        self.clients.pause(self.transport)
+
+    def resume_writing(self):
+        self.clients.resume(self.transport)
+
+    def data_received(self, data):
+        pass
+
+
+class StreamSender(Sender):
+    # CCSDS packets are self-delimiting through their length field, so a
+    # batch goes out back to back in a single write per consumer
+
+    def __init__(self, clients, batch=1):
+        super().__init__(None, None, batch)
+        self.clients = clients
+
+    def send(self, packets):
+        data = b''.join(packets)
+        for transport in self.clients.transports:
+            transport.write(data)
+            self.syscalls += 1
+        self.datagrams += len(packets)
+
+
+TRANSPORTS = ('udp', 'tcp', 'unix-dgram', 'unix-stream')
+
+
+async def open_tm_transport(simulator, rate):
+    # Returns something to close, an object with a 'writable' event for flow
+    # control, the Sender and, for UDP, our local address
+    loop = asyncio.get_running_loop()
+    kind = simulator.transport
+    if kind in ('udp', 'unix-dgram'):
+        family = socket.AF_INET if kind == 'udp' else socket.AF_UNIX
+        tm_socket = socket.socket(family, socket.SOCK_DGRAM)
+        tm_socket.setblocking(False)
+        if kind == 'udp':
+            # Bound to the local address that reaches Yamcs, so that our
+            # address is known before the first send, for recording
+            with socket.socket(family, socket.SOCK_DGRAM) as probe:
+                probe.connect(simulator.tm_address)
+                tm_socket.bind((probe.getsockname()[0], 0))
+        simulator.tm_buffer = size_socket_buffer(tm_socket, socket.SO_SNDBUF, rate)
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: TmProtocol(simulator.metrics), sock=tm_socket)
+        if kind == 'udp':
+            sender = create_sender(transport, simulator.tm_address, simulator.batch)
+            return transport, protocol, sender, tm_socket.getsockname()
+        return transport, protocol, create_sender(transport, simulator.tm_path, simulator.batch), None
+
+    # Stream transports: we are the server, like a ground station front end
+    # that Yamcs connects to
+    clients = StreamClients(rate)
+    if kind == 'tcp':
+        clients.server = await loop.create_server(
+            lambda: StreamProtocol(clients), *simulator.tm_address)
+    else:
+        if os.path.exists(simulator.tm_path):
+            os.unlink(simulator.tm_path)
+        clients.server = await loop.create_unix_server(
+            lambda: StreamProtocol(clients), simulator.tm_path)
+    try:
+        # Start the replay once the first consumer is there
+        await clients.connected.wait()
+    except asyncio.CancelledError:
+        clients.close()
+        raise
+    simulator.tm_buffer = clients.buffer
+    return clients, clients, StreamSender(clients, simulator.batch), None
+
+
+class TcProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def datagram_received(self, data, addr):
+        simulator = self.simulator
+        received = [data]
+        if simulator.recorder:
+            simulator.recorder.record(received, addr, simulator.tc_address)
+        if simulator.tc_impairment:
+            received = simulator.tc_impairment.apply(received)
+        if simulator.tc_link:
+            simulator.tc_link.put(received)
+        else:
+            self.deliver(received)
+
+    def deliver(self, received):
+        simulator = self.simulator
+        for data in received:
+            simulator.last_tc = data
+            simulator.tc_counter += 1
+            simulator.metrics.tc_received(data)
+
+
+async def send_tm(simulator):
+    reader = open_reader(simulator)
+    capture = getattr(reader, 'capture', None)
+    if isinstance(capture, PcapFile) and not simulator.repace:
+        simulator.pacer = ReplayPacer(capture.times, simulator.speed)
+    rate = simulator.pacer.rate()
+    if rate:
+        packet_size = len(capture.view) / max(1, len(capture)) if capture else 1024
+        rate = max(simulator.batch, rate) * packet_size
+    try:
+        transport, protocol, sender, source = await open_tm_transport(simulator, rate)
+    except BaseException:
+        reader.close()
+        raise
+    recorder = simulator.recorder if source else None
+    mirror = None
+    if simulator.mirror_address and simulator.transport == 'udp':
+        # Same socket, so both stations see the datagrams from one source
+        mirror = create_sender(transport, simulator.mirror_address, simulator.batch)
+    packets = out = None
+    link = simulator.tm_link
+    link_task = dump_task = None
+    try:
+        simulator.tm_counter = 1
+        pacer = simulator.pacer
+        simulator.tm_sender = sender
+        metrics = simulator.metrics
+        # Stream transports coalesce packets already
+        pack_size = simulator.pack if simulator.transport in ('udp', 'unix-dgram') else None
+        pack_checked = False
+
+        def send(packets):
+            nonlocal pack_checked
+            if pack_size:
+                if not pack_checked and packets:
+                    # Only packets of the same batch are packed together
+                    pack_checked = True
+                    fits = pack_size // max(map(len, packets))
+                    if sender.batch < fits:
+                        sys.stderr.write('--pack {} fits {} packets per datagram, but --batch {} packs at most {}, '
+                                         'raise --batch\n'.format(pack_size, fits, sender.batch, sender.batch))
+                packets = pack_datagrams(packets, pack_size)
+            sender.send(packets)
+            if mirror:
+                mirror.send(packets)
+            if recorder:
+                recorder.record(packets, source, simulator.tm_address)
+                if mirror:
+                    recorder.record(packets, source, simulator.mirror_address)
+        if link:
+            link_task = asyncio.create_task(link.run(send))
+        if simulator.passes:
+            dump_task = asyncio.create_task(dump_tm(simulator, simulator.passes))
+        while True:
+            count = await pacer.wait(sender.batch)
+            if pacer.period:
+                metrics.lateness.observe(pacer.last_lateness)
+            packets = await reader.take(count)
+            if not packets:
+                break
+            await protocol.writable.wait()
+            if simulator.apid is not None or simulator.loop:
+                if simulator.seq is None:
+                    simulator.seq = sequence_count(packets[0])
+                simulator.seq = rewrite_headers(packets, simulator.apid, simulator.seq)
+            wraps = getattr(reader, 'wraps', 0)
+            if wraps:
+                elapsed = wraps * reader.elapsed_span
+                orbits = reader.orbits.offsets(packets, elapsed)
+                shift_onboard_time(packets, elapsed, orbits)
+            out = packets
+            if simulator.passes:
+                # Packets that go to the recorder are counted by the pass model
+                out = simulator.passes.split(out)
+            realtime = len(out)
+            if simulator.tm_impairment:
+                out = simulator.tm_impairment.apply(out)
+            if link:
+                # Copied, as the packets are rewritten or reused before they arrive
+                out = [bytearray(packet) for packet in out]
+                link.put(out)
+            elif out:
+                send(out)
+            if wraps:
+                shift_onboard_time(packets, -elapsed, [-orbit for orbit in orbits])
+            simulator.tm_counter += realtime
+            metrics.tm_packets += len(out)
+            metrics.tm_bytes += sum(map(len, out))
+            if link:
+                await link.room.wait()
+        if simulator.tm_impairment:
+            out = simulator.tm_impairment.flush()
+            if link:
+                link.put(out)
+            elif out:
+                send(out)
+        if link:
+            await link.idle.wait()
+    finally:
+        # Drop our views of the capture, so that it can be closed
+        packets = out = None
+        if link_task:
+            link_task.cancel()
+        if dump_task:
+            dump_task.cancel()
+        transport.close()
+        reader.close()
+
+
+class Simulator():
+
+    def __init__(self, tm_file='testdata.ccsds', speed=1.0, batch=1,
+                 tm_address=('127.0.0.1', 10015), tc_address=('127.0.0.1', 10025),
+                 apid=None, capture=None, start_time=None, stop_time=None, loop=False,
+                 dump_address=('127.0.0.1', 10016), transport='udp', tm_path='/tmp/yamcs-tm.sock'):
+        self.tm_file = tm_file
+        # Range of onboard time (ElapsedSeconds) to replay
+        self.start_time = start_time
+        self.stop_time = stop_time
+        # Optional capture shared with other simulators in the same process
+        self.capture = capture
+        # When set, packets are sent with this APID and our own sequence count
+        self.apid = apid
+        # When looping, the capture restarts at its end and sequence count and
+        # onboard time are rewritten to keep the stream continuous
+        self.loop = loop
+        self.seq = None
+        self.tm_address = tm_address
+        self.tc_address = tc_address
+        # How TM is sent, one of TRANSPORTS. Unix sockets use tm_path.
+        self.transport = transport
+        self.tm_path = tm_path
+        # When set, datagrams carry as many packets as fit in this many bytes
+        self.pack = None
+        # Optional PassModel, recorded TM is dumped to dump_address
+        self.passes = None
+        self.dump_address = dump_address
+        # When set, UDP TM is also sent here, as received by a second ground station
+        self.mirror_address = None
+        self.speed = speed
+        self.pacer = Pacer(speed=speed)
+        # For pcap files: UDP port to replay, and whether to ignore the
+        # original timing and pace like a CCSDS capture
+        self.pcap_port = None
+        self.repace = False
+        # Optional PcapWriter for sent TM and received TC
+        self.recorder = None
+        self.batch = batch
+        self.tm_sender = None
         self.tm_counter = 0
         self.tc_counter = 0
-        self.tm_thread = None
-        self.tc_thread = None
+        self.tm_task = None
+        self.tc_transport = None
         self.last_tc = None
+        self.metrics = Metrics()
+        # Optional Impairment stages between packet source and socket
+        self.tm_impairment = None
+        self.tc_impairment = None
+        # Optional LinkModel for downlink and uplink delay
+        self.tm_link = None
+        self.tc_link = None
+        self.tc_link_task = None
+        # (requested, granted) socket buffer sizes
+        self.tm_buffer = None
+        self.tc_buffer = None
+        # Optional KernelDrops for the TM and TC ports
+        self.kernel_drops = None
+
+    async def start(self):
+        # Both streams run as part of the caller's event loop
+        loop = asyncio.get_running_loop()
+        if self.tc_address:
+            self.tc_transport, protocol = await loop.create_datagram_endpoint(
+                lambda: TcProtocol(self), local_addr=self.tc_address)
+            # Commands arrive at a low rate, the minimum covers bursts
+            self.tc_buffer = size_socket_buffer(
+                self.tc_transport.get_extra_info('socket'), socket.SO_RCVBUF, 0)
+            if self.tc_link:
+                self.tc_link_task = asyncio.create_task(self.tc_link.run(protocol.deliver))
+        self.tm_task = asyncio.create_task(send_tm(self))
 
-    def start(self):
-        self.tm_thread = Thread(target=send_tm, args=(self,))
-        self.tm_thread.daemon = True
-        self.tm_thread.start()
-        self.tc_thread = Thread(target=receive_tc, args=(self,))
-        self.tc_thread.daemon = True
-        self.tc_thread.start()
+    async def stop(self):
+        if self.tm_task:
+            self.tm_task.cancel()
+            try:
+                await self.tm_task
+            except asyncio.CancelledError:
+                pass
+            self.tm_task = None
+        if self.tc_link_task:
+            self.tc_link_task.cancel()
+            self.tc_link_task = None
+        if self.tc_transport:
+            self.tc_transport.close()
+            self.tc_transport = None
 
     def print_status(self):
         cmdhex = None
         if self.last_tc:
             cmdhex = binascii.hexlify(self.last_tc).decode('ascii')
-        return 'Sent: {} packets. Received: {} commands. Last command: {}'.format(
-                         self.tm_counter, self.tc_counter, cmdhex)
+        per_syscall = 0
+        if self.tm_sender and self.tm_sender.syscalls:
+            per_syscall = self.tm_sender.datagrams / self.tm_sender.syscalls
+        status = ('Sent: {} packets ({:.1f} per syscall). Lateness: {:.1f} ms (max {:.1f} ms). '
+                  'Received: {} commands. Last command: {}').format(
+                      self.tm_counter, per_syscall, self.pacer.last_lateness * 1000,
+                      self.pacer.max_lateness * 1000, self.tc_counter, cmdhex)
+        if self.metrics.tm_errors:
+            status += '. Send errors: {} (last: {})'.format(self.metrics.tm_errors, self.metrics.last_tm_error)
+        if self.tm_impairment:
+            status += '. TM impaired: ' + self.tm_impairment.status()
+        if self.tc_impairment:
+            status += '. TC impaired: ' + self.tc_impairment.status()
+        if self.kernel_drops:
+            status += '. Kernel: ' + self.kernel_drops.status()
+        if self.recorder:
+            status += '. Recorded: {} ({} dropped)'.format(self.recorder.written, self.recorder.dropped)
+        if self.passes:
+            status += '. Onboard: ' + self.passes.status()
+        if self.tm_link:
+            status += '. Downlink: ' + self.tm_link.status()
+        if self.tc_link:
+            status += '. Uplink: ' + self.tc_link.status()
+        return status
 
 
-if __name__ == '__main__':
-    simulator = Simulator()
-    simulator.start()
+async def main(args):
+    simulator = Simulator(tm_file=args.file, speed=args.speed, batch=args.batch,
+                          start_time=args.start, stop_time=args.stop, loop=args.loop,
+                          dump_address=('127.0.0.1', args.dump_port),
+                          transport=args.transport, tm_path=args.tm_path)
+    simulator.pcap_port = args.pcap_port
+    simulator.pack = args.pack
+    if args.mirror_port:
+        simulator.mirror_address = ('127.0.0.1', args.mirror_port)
+    simulator.repace = args.repace
+    if args.record:
+        simulator.recorder = PcapWriter(args.record)
+    if args.passes:
+        simulator.passes = PassModel(args.dump_rate, args.recorder_size)
+    log = io.open(args.impair_log, 'w') if args.impair_log else None
+    if args.tm_impair:
+        simulator.tm_impairment = Impairment('tm', seed=args.seed, log=log, **args.tm_impair)
+    if args.tc_impair:
+        simulator.tc_impairment = Impairment('tc', seed=args.seed + 1, log=log, **args.tc_impair)
+    if args.tm_link:
+        simulator.tm_link = LinkModel(seed=args.seed, **args.tm_link)
+    if args.tc_link:
+        simulator.tc_link = LinkModel(seed=args.seed + 1, **args.tc_link)
+    simulator.kernel_drops = KernelDrops([simulator.tm_address[1], simulator.tc_address[1]])
+    await simulator.start()
+    metrics_task = None
+    if args.metrics_port or args.metrics_file:
+        metrics_task = asyncio.create_task(serve_metrics(simulator, args.metrics_port, args.metrics_file,
+                                                         args.metrics_interval))
 
     try:
         prev_status = None
+        await asyncio.sleep(0)
+        for name, buffer in (('send', simulator.tm_buffer), ('receive', simulator.tc_buffer)):
+            if buffer and buffer[1] < buffer[0]:
+                sys.stderr.write('Socket {} buffer limited to {} bytes instead of {}, '
+                                 'raise net.core.{}mem_max\n'.format(
+                                     name, buffer[1], buffer[0], 'w' if name == 'send' else 'r'))
         while True:
+            if metrics_task and metrics_task.done():
+                # Raises why it stopped, such as the port being in use
+                metrics_task.result()
+            if simulator.tm_task.done():
+                # Raises why TM stopped, if it did not just reach the end
+                simulator.tm_task.result()
+            simulator.kernel_drops.sample()
+            simulator.metrics.kernel_drops = simulator.kernel_drops.drops
             status = simulator.print_status()
             if status != prev_status:
                 sys.stdout.write('\r')
                 sys.stdout.write(status)
                 sys.stdout.flush()
                 prev_status = status
-            sleep(0.5)
+            await asyncio.sleep(0.5)
+    finally:
+        if metrics_task:
+            metrics_task.cancel()
+            await asyncio.gather(metrics_task, return_exceptions=True)
+        await simulator.stop()
+        if log:
+            log.close()
+        if simulator.recorder:
+            simulator.recorder.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Yamcs QuickStart simulator')
+    parser.add_argument('--file', default='testdata.ccsds',
+                        help='CCSDS capture to replay (default: %(default)s)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed factor, 0 for as fast as possible (default: %(default)s)')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='max datagrams per sendmmsg call on Linux (default: %(default)s)')
+    parser.add_argument('--pack', type=parse_pack, metavar='BYTES',
+                        help='pack several packets per datagram, up to BYTES each '
+                             '(e.g. 1472 for a 1500 byte MTU)')
+    parser.add_argument('--mirror-port', type=int,
+                        help='also send UDP TM to this local port, as received by a second ground station')
+    parser.add_argument('--transport', choices=TRANSPORTS, default='udp',
+                        help='how to send TM (default: %(default)s)')
+    parser.add_argument('--tm-path', default='/tmp/yamcs-tm.sock',
+                        help='socket path for the Unix transports (default: %(default)s)')
+    parser.add_argument('--start', type=parse_elapsed,
+                        help='onboard time to start from, in seconds or [D:]HH:MM[:SS]')
+    parser.add_argument('--stop', type=parse_elapsed,
+                        help='onboard time to stop at, in seconds or [D:]HH:MM[:SS]')
+    parser.add_argument('--pcap-port', type=int,
+                        help='when replaying a pcap file, only send datagrams to this UDP port')
+    parser.add_argument('--repace', action='store_true',
+                        help='replay a pcap file one packet per second (scaled by --speed) '
+                             'instead of at its original timing')
+    parser.add_argument('--record', metavar='FILE',
+                        help='record sent TM and received TC to a pcap file')
+    parser.add_argument('--loop', action='store_true',
+                        help='replay the capture endlessly, keeping the stream continuous')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics in Prometheus text format on this local port')
+    parser.add_argument('--metrics-file',
+                        help='write metrics in Prometheus text format to this file')
+    parser.add_argument('--metrics-interval', type=float, default=10.0,
+                        help='seconds between metrics file updates and rate samples (default: %(default)s)')
+    parser.add_argument('--tm-impair', type=parse_impairment, metavar='SPEC',
+                        help='impair TM, e.g. loss=0.01,burst=0.001:0.1,dup=0.001,reorder=0.01:8,corrupt=1e-5')
+    parser.add_argument('--tc-impair', type=parse_impairment, metavar='SPEC',
+                        help='impair received TC, same format as --tm-impair')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for impairments (default: %(default)s)')
+    parser.add_argument('--impair-log',
+                        help='file to log every impaired packet to')
+    parser.add_argument('--passes', action='store_true',
+                        help='send TM in realtime only during ground station passes, dump the rest')
+    parser.add_argument('--dump-rate', type=float, default=1000.0,
+                        help='packets per second of recorded TM dumped during a pass (default: %(default)s)')
+    parser.add_argument('--dump-port', type=int, default=10016,
+                        help='local UDP port to dump recorded TM to (default: %(default)s)')
+    parser.add_argument('--recorder-size', type=int,
+                        help='onboard recorder size in packets, the oldest are overwritten (default: unlimited)')
+    parser.add_argument('--tm-link', type=parse_link, metavar='SPEC',
+                        help='delay TM over a modelled downlink, e.g. delay=0.25,jitter=0.01,rate=64000')
+    parser.add_argument('--tc-link', type=parse_link, metavar='SPEC',
+                        help='delay received TC over a modelled uplink, same format as --tm-link')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
     except KeyboardInterrupt:
         sys.stdout.write('\n')
         sys.stdout.flush()
@@ -0,0 +1,143 @@
+package com.example.myproject;
+
+import java.util.Arrays;
+import java.util.HashMap;
+import java.util.Map;
+
+/**
+ * Drops packets that already arrived on another TM link, when the same downlink is received through several ground
+ * stations. One filter is shared by all links of a Yamcs instance.
+ * <p>
+ * Each APID has a sliding window over its recent sequence counts, extended beyond 14 bits, with one bit per count
+ * that has been accepted. A packet is a duplicate when its bit is already set. Generation times bound the window:
+ * when an APID has been quiet for longer than the timeout, the window is cleared, so that a reset or wrapped counter
+ * is not mistaken for duplicates. The extended count then carries on forward from where it was, so that the gap ledger
+ * numbering only goes up. Packets older than the window are let through.
+ * <p>
+ * As the filter sees the merged stream of all links, it also keeps the {@link GapLedger} up to date for them.
+ */
+public class DuplicateFilter {
+
+    public static final int DEFAULT_WINDOW = 4096;
+    public static final long DEFAULT_TIMEOUT = 60000;
+
+    private static final Map<String, DuplicateFilter> filters = new HashMap<>();
+
+    private final int window;
+    private final long timeout;
+    private final GapLedger gapLedger;
+    private final Window[] windows = new Window[2048];
+
+    static class Window {
+        long highest = -1; // highest accepted sequence count, extended
+        long lastTime; // generation time of the last accepted packet
+        final long[] bits;
+
+        Window(int size) {
+            bits = new long[size / 64];
+        }
+
+        boolean get(long seq) {
+            int i = (int) (seq % (bits.length * 64));
+            return (bits[i >> 6] & (1L << i)) != 0;
+        }
+
+        void set(long seq) {
+            int i = (int) (seq % (bits.length * 64));
+            bits[i >> 6] |= 1L << i;
+        }
+
+        void clear(long seq) {
+            int i = (int) (seq % (bits.length * 64));
+            bits[i >> 6] &= ~(1L << i);
+        }
+    }
+
+    private DuplicateFilter(String yamcsInstance, int window, long timeout) {
+        // Late packets can only be told apart from wrapped ones up to half the 14-bit range
+        this.window = Math.max(64, Math.min(0x2000, window / 64 * 64));
+        this.timeout = timeout;
+        this.gapLedger = GapLedger.getInstance(yamcsInstance);
+    }
+
+    /**
+     * Returns the filter of the instance. The window size (a multiple of 64, up to 8192) and timeout in milliseconds
+     * are taken from the first caller.
+     */
+    public static synchronized DuplicateFilter getInstance(String yamcsInstance, int window, long timeout) {
+        return filters.computeIfAbsent(yamcsInstance, k -> new DuplicateFilter(k, window, timeout));
+    }
+
+    private synchronized Window getWindow(int apid) {
+        Window w = windows[apid];
+        if (w == null) {
+            w = new Window(window);
+            windows[apid] = w;
+        }
+        return w;
+    }
+
+    /**
+     * Returns true if a packet with this APID and 14-bit sequence count has already been accepted, otherwise accepts
+     * it.
+     */
+    public boolean isDuplicate(int apid, int seq, long gentime) {
+        Window w = windows[apid];
+        if (w == null) {
+            w = getWindow(apid);
+        }
+        synchronized (w) {
+            if (w.highest < 0) {
+                // Starts one wrap up, so that late counts from before the first packet do not go negative
+                w.highest = seq + 0x4000;
+                w.lastTime = gentime;
+                w.set(w.highest);
+                return false;
+            }
+            int diff = (seq - (int) w.highest) & 0x3FFF;
+            if (gentime - w.lastTime > timeout || w.lastTime - gentime > timeout) {
+                // Whatever the counter did meanwhile, take it as having moved forward
+                Arrays.fill(w.bits, 0);
+                long highest = w.highest + diff;
+                if (diff > 1) {
+                    gapLedger.addGap(apid, w.highest + 1, highest - 1);
+                }
+                w.highest = highest;
+                w.lastTime = gentime;
+                w.set(highest);
+                return false;
+            }
+            if (diff == 0) {
+                return true;
+            }
+            if (diff < 0x2000) {
+                long highest = w.highest + diff;
+                if (diff >= window) {
+                    Arrays.fill(w.bits, 0);
+                } else {
+                    for (long s = w.highest + 1; s < highest; s++) {
+                        w.clear(s);
+                    }
+                }
+                w.set(highest);
+                if (diff > 1) {
+                    gapLedger.addGap(apid, w.highest + 1, highest - 1);
+                }
+                w.highest = highest;
+                w.lastTime = gentime;
+                return false;
+            }
+            // Behind the highest count, a late packet or one from a slower link
+            long late = w.highest - (0x4000 - diff);
+            if (w.highest - late >= window) {
+                return false;
+            }
+            if (w.get(late)) {
+                return true;
+            }
+            w.set(late);
+            gapLedger.fill(apid, late);
+            return false;
+        }
+    }
+}
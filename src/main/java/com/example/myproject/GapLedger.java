@@ -0,0 +1,204 @@
+package com.example.myproject;
+
+import java.util.ArrayList;
+import java.util.Collection;
+import java.util.HashMap;
+import java.util.Iterator;
+import java.util.List;
+import java.util.Map;
+import java.util.TreeMap;
+
+import org.yamcs.parameter.ParameterValue;
+import org.yamcs.parameter.SystemParametersProducer;
+import org.yamcs.parameter.SystemParametersService;
+import org.yamcs.protobuf.Yamcs.Value.Type;
+import org.yamcs.xtce.Parameter;
+
+/**
+ * Missing CCSDS sequence count ranges per APID, shared by all links of a Yamcs instance.
+ * <p>
+ * Sequence counts are extended beyond their 14 bits by the preprocessor that records the gaps, so that ranges stay
+ * unambiguous when the counter wraps. Ranges are kept merged, and shrink or split when late or dumped packets fill
+ * them.
+ * <p>
+ * The ledger is published as system parameters, for every APID that had a gap:
+ * <ul>
+ * <li><code>/yamcs/&lt;instance&gt;/gaps/APID_&lt;apid&gt;/missing</code>: number of missing packets</li>
+ * <li><code>/yamcs/&lt;instance&gt;/gaps/APID_&lt;apid&gt;/ranges</code>: number of missing ranges</li>
+ * <li><code>/yamcs/&lt;instance&gt;/gaps/APID_&lt;apid&gt;/list</code>: the oldest ranges as
+ * <code>first-last</code> sequence counts, for retransmission requests</li>
+ * </ul>
+ */
+public class GapLedger implements SystemParametersProducer {
+
+    // Oldest ranges are forgotten beyond this, per APID
+    static final int MAX_RANGES = 10000;
+
+    // Ranges listed in the 'list' parameter
+    static final int MAX_LISTED = 100;
+
+    private static final Map<String, GapLedger> ledgers = new HashMap<>();
+
+    private final String yamcsInstance;
+
+    // Missing ranges of extended sequence counts, first to last (inclusive), per APID
+    private final Map<Integer, TreeMap<Long, Long>> gaps = new HashMap<>();
+    private final long[] missingCounts = new long[2048];
+
+    // Read without locking, to skip APIDs without gaps
+    private volatile int rangeCount;
+
+    private boolean registered;
+    private final Map<Integer, Parameter[]> parameters = new HashMap<>();
+
+    private GapLedger(String yamcsInstance) {
+        this.yamcsInstance = yamcsInstance;
+    }
+
+    public static synchronized GapLedger getInstance(String yamcsInstance) {
+        return ledgers.computeIfAbsent(yamcsInstance, GapLedger::new);
+    }
+
+    /**
+     * Records that the packets from first to last (extended sequence counts, inclusive) are missing.
+     */
+    public synchronized void addGap(int apid, long first, long last) {
+        if (!registered) {
+            // Registered lazily, the service may not be up yet when links are created. If it is not up yet either,
+            // the next gap tries again.
+            SystemParametersService service = SystemParametersService.getInstance(yamcsInstance);
+            if (service != null) {
+                service.registerProducer(this);
+                registered = true;
+            }
+        }
+        TreeMap<Long, Long> ranges = gaps.computeIfAbsent(apid, k -> new TreeMap<>());
+        Map.Entry<Long, Long> before = ranges.floorEntry(first);
+        if (before != null && before.getValue() >= first - 1) {
+            missingCounts[apid] -= before.getValue() - before.getKey() + 1;
+            first = before.getKey();
+            last = Math.max(last, before.getValue());
+            ranges.remove(before.getKey());
+        }
+        Map.Entry<Long, Long> after = ranges.ceilingEntry(first);
+        while (after != null && after.getKey() <= last + 1) {
+            missingCounts[apid] -= after.getValue() - after.getKey() + 1;
+            last = Math.max(last, after.getValue());
+            ranges.remove(after.getKey());
+            after = ranges.ceilingEntry(first);
+        }
+        ranges.put(first, last);
+        missingCounts[apid] += last - first + 1;
+
+        while (ranges.size() > MAX_RANGES) {
+            Map.Entry<Long, Long> oldest = ranges.pollFirstEntry();
+            missingCounts[apid] -= oldest.getValue() - oldest.getKey() + 1;
+        }
+        updateRangeCount();
+    }
+
+    /**
+     * Records that the packet with the given extended sequence count has been received.
+     */
+    public synchronized void fill(int apid, long seq) {
+        TreeMap<Long, Long> ranges = gaps.get(apid);
+        if (ranges == null) {
+            return;
+        }
+        Map.Entry<Long, Long> range = ranges.floorEntry(seq);
+        if (range == null || range.getValue() < seq) {
+            return;
+        }
+        long first = range.getKey();
+        long last = range.getValue();
+        ranges.remove(first);
+        if (first < seq) {
+            ranges.put(first, seq - 1);
+        }
+        if (seq < last) {
+            ranges.put(seq + 1, last);
+        }
+        missingCounts[apid]--;
+        updateRangeCount();
+    }
+
+    /**
+     * Records that a packet with the given 14-bit sequence count has been received on a link that does not follow
+     * the sequence, such as a dump. It fills the oldest missing range that contains this count.
+     */
+    public void fillSeqCount(int apid, int seq) {
+        if (rangeCount == 0) {
+            return;
+        }
+        synchronized (this) {
+            TreeMap<Long, Long> ranges = gaps.get(apid);
+            if (ranges == null) {
+                return;
+            }
+            for (Map.Entry<Long, Long> range : ranges.entrySet()) {
+                long candidate = range.getKey() + ((seq - range.getKey()) & 0x3FFF);
+                if (candidate <= range.getValue()) {
+                    fill(apid, candidate);
+                    return;
+                }
+            }
+        }
+    }
+
+    public synchronized long getMissingCount(int apid) {
+        return missingCounts[apid];
+    }
+
+    /**
+     * Returns the missing ranges of an APID as pairs of extended sequence counts, oldest first.
+     */
+    public synchronized List<long[]> getGaps(int apid) {
+        List<long[]> result = new ArrayList<>();
+        TreeMap<Long, Long> ranges = gaps.get(apid);
+        if (ranges != null) {
+            for (Map.Entry<Long, Long> range : ranges.entrySet()) {
+                result.add(new long[] { range.getKey(), range.getValue() });
+            }
+        }
+        return result;
+    }
+
+    private void updateRangeCount() {
+        int count = 0;
+        for (TreeMap<Long, Long> ranges : gaps.values()) {
+            count += ranges.size();
+        }
+        rangeCount = count;
+    }
+
+    @Override
+    public synchronized Collection<ParameterValue> getSystemParameters(long gentime) {
+        SystemParametersService service = SystemParametersService.getInstance(yamcsInstance);
+        List<ParameterValue> result = new ArrayList<>();
+        for (Map.Entry<Integer, TreeMap<Long, Long>> entry : gaps.entrySet()) {
+            int apid = entry.getKey();
+            TreeMap<Long, Long> ranges = entry.getValue();
+            Parameter[] p = parameters.computeIfAbsent(apid, k -> new Parameter[] {
+                    service.createSystemParameter("gaps/APID_" + apid + "/missing", Type.UINT64,
+                            "Number of packets missing"),
+                    service.createSystemParameter("gaps/APID_" + apid + "/ranges", Type.UINT64,
+                            "Number of ranges of missing packets"),
+                    service.createSystemParameter("gaps/APID_" + apid + "/list", Type.STRING,
+                            "Oldest ranges of missing sequence counts") });
+
+            StringBuilder list = new StringBuilder();
+            Iterator<Map.Entry<Long, Long>> it = ranges.entrySet().iterator();
+            for (int i = 0; i < MAX_LISTED && it.hasNext(); i++) {
+                Map.Entry<Long, Long> range = it.next();
+                if (list.length() > 0) {
+                    list.append(',');
+                }
+                list.append(range.getKey() & 0x3FFF).append('-').append(range.getValue() & 0x3FFF);
+            }
+            result.add(SystemParametersService.getPV(p[0], gentime, missingCounts[apid]));
+            result.add(SystemParametersService.getPV(p[1], gentime, (long) ranges.size()));
+            result.add(SystemParametersService.getPV(p[2], gentime, list.toString()));
+        }
+        return result;
+    }
+}
@@ -0,0 +1,173 @@
+package com.example.myproject;
+
+import java.util.ArrayList;
+import java.util.Collection;
+import java.util.List;
+import java.util.concurrent.atomic.AtomicLong;
+
+import org.yamcs.parameter.ParameterValue;
+import org.yamcs.parameter.SystemParametersProducer;
+import org.yamcs.parameter.SystemParametersService;
+import org.yamcs.protobuf.Yamcs.Value.Type;
+import org.yamcs.xtce.Parameter;
+
+/**
+ * Ingest statistics of a packet preprocessor, published once per second as system parameters under
+ * <code>/yamcs/&lt;instance&gt;/ingest/&lt;name&gt;/</code>:
+ * <ul>
+ * <li><code>packetsPerSecond</code>, <code>bytesPerSecond</code>: rates over the last second</li>
+ * <li><code>droppedPackets</code>: packets dropped by the preprocessor</li>
+ * <li><code>duplicatePackets</code>: dropped packets that had already arrived on another link</li>
+ * <li><code>processingTimeP50</code>, <code>processingTimeP99</code>, <code>processingTimeMax</code>: nanoseconds
+ * spent per packet over the last second</li>
+ * <li><code>jumps/APID_&lt;apid&gt;</code>: sequence count jumps, for every APID that had one</li>
+ * </ul>
+ * <p>
+ * Counters are plain fields written by the ingest thread only. The collector thread works on differences between
+ * successive readings, so a reading that is slightly out of date only shifts counts to the next second. The maximum
+ * processing time is reset by the collector every second, so it is an atomic instead.
+ */
+public class IngestStats implements SystemParametersProducer {
+
+    // Log-linear buckets: 4 per power of two, good to 25% accuracy
+    static final int BUCKETS = 248;
+
+    private final String name;
+
+    private long packets;
+    private long bytes;
+    private long drops;
+    private long duplicates;
+    private final AtomicLong maxNanos = new AtomicLong();
+    private final long[] histogram = new long[BUCKETS];
+    private final long[] jumps = new long[2048];
+
+    // Collector state
+    private SystemParametersService service;
+    private long lastTime = -1;
+    private long lastPackets;
+    private long lastBytes;
+    private final long[] lastHistogram = new long[BUCKETS];
+    private Parameter spPacketRate, spByteRate, spDrops, spDuplicates, spP50, spP99, spMax;
+    private final Parameter[] spJumps = new Parameter[2048];
+
+    public IngestStats(String name) {
+        this.name = name;
+    }
+
+    public void setupSystemParameters(SystemParametersService service) {
+        this.service = service;
+        String prefix = "ingest/" + name + "/";
+        spPacketRate = service.createSystemParameter(prefix + "packetsPerSecond", Type.DOUBLE,
+                "Packets processed per second");
+        spByteRate = service.createSystemParameter(prefix + "bytesPerSecond", Type.DOUBLE,
+                "Bytes processed per second");
+        spDrops = service.createSystemParameter(prefix + "droppedPackets", Type.UINT64,
+                "Packets dropped by the preprocessor");
+        spDuplicates = service.createSystemParameter(prefix + "duplicatePackets", Type.UINT64,
+                "Packets dropped because they had already arrived on another link");
+        spP50 = service.createSystemParameter(prefix + "processingTimeP50", Type.UINT64,
+                "Median processing time per packet over the last second, in nanoseconds");
+        spP99 = service.createSystemParameter(prefix + "processingTimeP99", Type.UINT64,
+                "99th percentile of the processing time per packet over the last second, in nanoseconds");
+        spMax = service.createSystemParameter(prefix + "processingTimeMax", Type.UINT64,
+                "Longest processing time of a packet over the last second, in nanoseconds");
+        service.registerProducer(this);
+    }
+
+    public void packetProcessed(int length, long nanos, boolean dropped) {
+        packets++;
+        bytes += length;
+        if (dropped) {
+            drops++;
+        }
+        histogram[bucket(nanos)]++;
+        if (nanos > maxNanos.get()) {
+            maxNanos.accumulateAndGet(nanos, Math::max);
+        }
+    }
+
+    public void duplicate() {
+        duplicates++;
+    }
+
+    public void seqCountJump(int apid) {
+        jumps[apid]++;
+    }
+
+    static int bucket(long nanos) {
+        if (nanos < 4) {
+            return (int) Math.max(0, nanos);
+        }
+        int log2 = 63 - Long.numberOfLeadingZeros(nanos);
+        return (log2 << 2) + (int) ((nanos >>> (log2 - 2)) & 3) - 4;
+    }
+
+    static long upperBound(int bucket) {
+        if (bucket < 4) {
+            return bucket;
+        }
+        int log2 = (bucket + 4) >> 2;
+        long width = 1L << (log2 - 2);
+        return (4 + ((bucket + 4) & 3)) * width + width - 1;
+    }
+
+    private static long percentile(long[] counts, long total, double q) {
+        long rank = (long) Math.ceil(q * total);
+        long cumulative = 0;
+        for (int i = 0; i < counts.length; i++) {
+            cumulative += counts[i];
+            if (cumulative >= rank) {
+                return upperBound(i);
+            }
+        }
+        return 0;
+    }
+
+    @Override
+    public Collection<ParameterValue> getSystemParameters(long gentime) {
+        long packets = this.packets;
+        long bytes = this.bytes;
+        long max = maxNanos.getAndSet(0);
+
+        long[] counts = new long[BUCKETS];
+        long total = 0;
+        for (int i = 0; i < BUCKETS; i++) {
+            long count = histogram[i];
+            counts[i] = count - lastHistogram[i];
+            lastHistogram[i] = count;
+            total += counts[i];
+        }
+
+        List<ParameterValue> result = new ArrayList<>();
+        if (lastTime >= 0 && gentime > lastTime) {
+            double seconds = (gentime - lastTime) / 1000.0;
+            result.add(SystemParametersService.getPV(spPacketRate, gentime, (packets - lastPackets) / seconds));
+            result.add(SystemParametersService.getPV(spByteRate, gentime, (bytes - lastBytes) / seconds));
+        }
+        lastTime = gentime;
+        lastPackets = packets;
+        lastBytes = bytes;
+
+        result.add(SystemParametersService.getPV(spDrops, gentime, drops));
+        result.add(SystemParametersService.getPV(spDuplicates, gentime, duplicates));
+        if (total > 0) {
+            result.add(SystemParametersService.getPV(spP50, gentime, Math.min(max, percentile(counts, total, 0.5))));
+            result.add(SystemParametersService.getPV(spP99, gentime, Math.min(max, percentile(counts, total, 0.99))));
+            result.add(SystemParametersService.getPV(spMax, gentime, max));
+        }
+
+        for (int apid = 0; apid < jumps.length; apid++) {
+            long count = jumps[apid];
+            if (count == 0) {
+                continue;
+            }
+            if (spJumps[apid] == null) {
+                spJumps[apid] = service.createSystemParameter("ingest/" + name + "/jumps/APID_" + apid,
+                        Type.UINT64, "Sequence count jumps of APID " + apid);
+            }
+            result.add(SystemParametersService.getPV(spJumps[apid], gentime, count));
+        }
+        return result;
+    }
+}
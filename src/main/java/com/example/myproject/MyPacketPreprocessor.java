@@ -1,37 +1,92 @@
 package com.example.myproject;
 
-import java.nio.ByteBuffer;
-import java.util.HashMap;
-import java.util.Map;
+import java.util.Arrays;
+import java.util.concurrent.Executors;
+import java.util.concurrent.ScheduledExecutorService;
+import java.util.concurrent.TimeUnit;
 import java.util.concurrent.atomic.AtomicInteger;
 
 import org.yamcs.TmPacket;
 import org.yamcs.YConfiguration;
+import org.yamcs.parameter.SystemParametersService;
 import org.yamcs.tctm.AbstractPacketPreprocessor;
+import org.yamcs.utils.ByteArrayUtils;
 import org.yamcs.utils.TimeEncoding;
 
 /**
  * Component capable of modifying packet binary received from a link, before passing it further into Yamcs.
  * <p>
- * A single instance of this class is created, scoped to the link udp-in.
- * <p>
- * This is specified in the configuration file yamcs.myproject.yaml:
+ * One instance of this class is created per TM link that names it. In yamcs.myproject.yaml these are udp-in, udp-in-2,
+ * udp-dump and tcp-in, each with its own <code>packetPreprocessorArgs</code>:
  * 
  * <pre>
  * ...
  * dataLinks:
  *   - name: udp-in
- *     class: org.yamcs.tctm.UdpTmDataLink
+ *     class: com.example.myproject.MyUdpTmDataLink
  *     stream: tm_realtime
- *     host: localhost
  *     port: 10015
  *     packetPreprocessorClassName: com.example.myproject.MyPacketPreprocessor
+ *     packetPreprocessorArgs:
+ *       statsName: udp-in
+ *       deduplicate: true
  * ...
  * </pre>
+ * <p>
+ * To keep event volume bounded on a bad link, SHORT_PACKET and SEQ_COUNT_JUMP (per APID) are only sent for the first
+ * occurrence. Later occurrences are counted and reported in a summary event every
+ * <code>eventSummaryInterval</code> seconds (default 10), until an interval passes without any.
+ * <p>
+ * Missing sequence ranges are recorded in the {@link GapLedger} of the instance. Links that do not carry a
+ * continuous sequence, such as dumps, should set <code>recordGaps: false</code>: their packets only fill gaps.
+ * <p>
+ * Ingest rates and processing times are published as system parameters, see {@link IngestStats}. They are named
+ * after <code>statsName</code>, which defaults to <code>preprocessor&lt;n&gt;</code>.
+ * <p>
+ * Links that receive the same downlink through different ground stations set <code>deduplicate: true</code>. Packets
+ * already received on any of these links are then dropped by a shared {@link DuplicateFilter}, which also records
+ * the gaps of the merged stream. As it numbers sequence counts on its own, realtime links of one instance should
+ * either all deduplicate or all not. <code>dedupWindow</code> (sequence counts, default 4096) and
+ * <code>dedupTimeout</code> (milliseconds, default 60000) configure it.
  */
 public class MyPacketPreprocessor extends AbstractPacketPreprocessor {
 
-    private Map<Integer, AtomicInteger> seqCounts = new HashMap<>();
+    // Sends the summary events of all preprocessors
+    private static final ScheduledExecutorService summaryExecutor = Executors.newSingleThreadScheduledExecutor(r -> {
+        Thread thread = new Thread(r, "MyPacketPreprocessor-events");
+        thread.setDaemon(true);
+        return thread;
+    });
+
+    private static final AtomicInteger instanceCount = new AtomicInteger();
+
+    // Last sequence count, indexed by the 11-bit APID. Packets of a link are processed by a single thread, and a
+    // primitive array keeps the per-packet path free of allocations.
+    private final int[] seqCounts = new int[2048];
+
+    private final int summaryInterval;
+
+    private final String yamcsInstance;
+    private final IngestStats stats;
+    private int registerAttempts;
+
+    private final GapLedger gapLedger;
+    private final boolean recordGaps;
+    private final DuplicateFilter duplicateFilter;
+
+    // Highest sequence count received, extended beyond 14 bits so that it does not wrap. -1 before the first packet.
+    private final long[] highestSeqs = new long[2048];
+
+    // Suppression state, only touched when something is wrong and guarded by 'this'
+    private final boolean[] jumpReported = new boolean[2048];
+    private final int[] jumpCounts = new int[2048];
+    private final long[] missingCounts = new long[2048];
+    private final int[] lastOldSeqs = new int[2048];
+    private final int[] lastSeqs = new int[2048];
+    private boolean shortReported;
+    private int shortCount;
+    private int shortMinLength;
+    private int shortMaxLength;
 
     // Constructor used when this preprocessor is used without YAML configuration
     public MyPacketPreprocessor(String yamcsInstance) {
@@ -42,35 +97,85 @@ public class MyPacketPreprocessor extends AbstractPacketPreprocessor {
     // (packetPreprocessorClassArgs)
     public MyPacketPreprocessor(String yamcsInstance, YConfiguration config) {
         super(yamcsInstance, config);
+        this.yamcsInstance = yamcsInstance;
+        summaryInterval = config.getInt("eventSummaryInterval", 10);
+        stats = new IngestStats(config.getString("statsName", "preprocessor" + instanceCount.incrementAndGet()));
+        summaryExecutor.schedule(this::registerStats, 1, TimeUnit.SECONDS);
+        recordGaps = config.getBoolean("recordGaps", true);
+        gapLedger = GapLedger.getInstance(yamcsInstance);
+        if (config.getBoolean("deduplicate", false)) {
+            duplicateFilter = DuplicateFilter.getInstance(yamcsInstance,
+                    config.getInt("dedupWindow", DuplicateFilter.DEFAULT_WINDOW),
+                    config.getLong("dedupTimeout", DuplicateFilter.DEFAULT_TIMEOUT));
+        } else {
+            duplicateFilter = null;
+        }
+        Arrays.fill(highestSeqs, -1);
+        summaryExecutor.scheduleAtFixedRate(this::sendSummaries, summaryInterval, summaryInterval,
+                TimeUnit.SECONDS);
+    }
+
+    // The system parameters service may start after the links are created
+    private void registerStats() {
+        SystemParametersService service = SystemParametersService.getInstance(yamcsInstance);
+        if (service != null) {
+            stats.setupSystemParameters(service);
+        } else if (++registerAttempts < 60) {
+            summaryExecutor.schedule(this::registerStats, 1, TimeUnit.SECONDS);
+        }
     }
 
     @Override
     public TmPacket process(TmPacket packet) {
+        long start = System.nanoTime();
+        TmPacket result = doProcess(packet);
+        stats.packetProcessed(packet.getPacket().length, System.nanoTime() - start, result == null);
+        return result;
+    }
+
+    private TmPacket doProcess(TmPacket packet) {
 
         byte[] bytes = packet.getPacket();
         if (bytes.length < 6) { // Expect at least the length of CCSDS primary header
-            eventProducer.sendWarning("SHORT_PACKET",
-                    "Short packet received, length: " + bytes.length + "; minimum required length is 6 bytes.");
+            shortPacket(bytes.length);
 
             // If we return null, the packet is dropped.
             return null;
         }
 
         // Verify continuity for a given APID based on the CCSDS sequence counter
-        int apidseqcount = ByteBuffer.wrap(bytes).getInt(0);
+        int apidseqcount = ByteArrayUtils.decodeInt(bytes, 0);
         int apid = (apidseqcount >> 16) & 0x07FF;
         int seq = (apidseqcount) & 0x3FFF;
-        AtomicInteger ai = seqCounts.computeIfAbsent(apid, k -> new AtomicInteger());
-        int oldseq = ai.getAndSet(seq);
+        int oldseq = seqCounts[apid];
+        seqCounts[apid] = seq;
 
         if (((seq - oldseq) & 0x3FFF) != 1) {
-            eventProducer.sendWarning("SEQ_COUNT_JUMP",
-                    "Sequence count jump for APID: " + apid + " old seq: " + oldseq + " newseq: " + seq);
+            seqCountJump(apid, oldseq, seq);
         }
 
         // Our custom packets don't include a secundary header with time information.
         // Use Yamcs-local time instead.
-        packet.setGenerationTime(TimeEncoding.getWallclockTime());
+        long gentime = TimeEncoding.getWallclockTime();
+
+        if (duplicateFilter != null) {
+            if (duplicateFilter.isDuplicate(apid, seq, gentime)) {
+                stats.duplicate();
+                return null;
+            }
+        } else if (recordGaps) {
+            long highest = highestSeqs[apid];
+            int diff = (seq - (int) highest) & 0x3FFF;
+            if (diff == 1 && highest >= 0) {
+                highestSeqs[apid] = highest + 1;
+            } else {
+                updateGaps(apid, highest, diff, seq);
+            }
+        } else {
+            gapLedger.fillSeqCount(apid, seq);
+        }
+
+        packet.setGenerationTime(gentime);
 
         // Use the full 32-bits, so that both APID and the count are included.
         // Yamcs uses this attribute to uniquely identify the packet (together with the gentime)
@@ -78,4 +183,76 @@ public class MyPacketPreprocessor extends AbstractPacketPreprocessor {
 
         return packet;
     }
+
+    private void updateGaps(int apid, long highest, int diff, int seq) {
+        if (highest < 0) {
+            highestSeqs[apid] = seq;
+        } else if (diff == 0) {
+            // Repeated packet
+        } else if (diff < 0x2000) {
+            gapLedger.addGap(apid, highest + 1, highest + diff - 1);
+            highestSeqs[apid] = highest + diff;
+        } else {
+            // Late packet
+            gapLedger.fill(apid, highest - (0x4000 - diff));
+        }
+    }
+
+    private synchronized void shortPacket(int length) {
+        if (!shortReported) {
+            shortReported = true;
+            eventProducer.sendWarning("SHORT_PACKET",
+                    "Short packet received, length: " + length + "; minimum required length is 6 bytes.");
+            return;
+        }
+        if (shortCount == 0) {
+            shortMinLength = length;
+            shortMaxLength = length;
+        } else {
+            shortMinLength = Math.min(shortMinLength, length);
+            shortMaxLength = Math.max(shortMaxLength, length);
+        }
+        shortCount++;
+    }
+
+    private synchronized void seqCountJump(int apid, int oldseq, int seq) {
+        stats.seqCountJump(apid);
+        if (!jumpReported[apid]) {
+            jumpReported[apid] = true;
+            eventProducer.sendWarning("SEQ_COUNT_JUMP",
+                    "Sequence count jump for APID: " + apid + " old seq: " + oldseq + " newseq: " + seq);
+            return;
+        }
+        jumpCounts[apid]++;
+        int gap = ((seq - oldseq) & 0x3FFF) - 1;
+        if (gap < 0x2000) { // Larger gaps are more likely repeated or reordered packets
+            missingCounts[apid] += gap;
+        }
+        lastOldSeqs[apid] = oldseq;
+        lastSeqs[apid] = seq;
+    }
+
+    private synchronized void sendSummaries() {
+        for (int apid = 0; apid < jumpCounts.length; apid++) {
+            if (jumpCounts[apid] > 0) {
+                eventProducer.sendWarning("SEQ_COUNT_JUMP", String.format(
+                        "APID %d: %d more jumps, %d packets missing in last %d s (last old seq: %d newseq: %d)",
+                        apid, jumpCounts[apid], missingCounts[apid], summaryInterval, lastOldSeqs[apid],
+                        lastSeqs[apid]));
+                jumpCounts[apid] = 0;
+                missingCounts[apid] = 0;
+            } else {
+                // Quiet for a whole interval, report the next jump right away
+                jumpReported[apid] = false;
+            }
+        }
+        if (shortCount > 0) {
+            eventProducer.sendWarning("SHORT_PACKET", String.format(
+                    "%d more short packets in last %d s, lengths %d to %d bytes; minimum required length is 6 bytes.",
+                    shortCount, summaryInterval, shortMinLength, shortMaxLength));
+            shortCount = 0;
+        } else {
+            shortReported = false;
+        }
+    }
 }
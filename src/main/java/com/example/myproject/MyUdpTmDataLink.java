@@ -0,0 +1,147 @@
+package com.example.myproject;
+
+import java.io.IOException;
+import java.net.DatagramPacket;
+import java.net.DatagramSocket;
+import java.net.SocketException;
+import java.util.Arrays;
+
+import org.yamcs.ConfigurationException;
+import org.yamcs.TmPacket;
+import org.yamcs.YConfiguration;
+import org.yamcs.tctm.AbstractTmDataLink;
+
+/**
+ * UDP TM link that accepts several CCSDS packets per datagram, as sent by <code>simulator.py --pack</code>.
+ * <p>
+ * Each datagram is cut into packets using the CCSDS length field, and each packet goes through the packet
+ * preprocessor on its own. A datagram that holds a single packet is handled exactly like by
+ * {@link org.yamcs.tctm.UdpTmDataLink}, so this link can replace it.
+ * <p>
+ * This is specified in the configuration file yamcs.myproject.yaml:
+ *
+ * <pre>
+ * ...
+ * dataLinks:
+ *   - name: udp-in
+ *     class: com.example.myproject.MyUdpTmDataLink
+ *     stream: tm_realtime
+ *     port: 10015
+ *     packetPreprocessorClassName: com.example.myproject.MyPacketPreprocessor
+ * ...
+ * </pre>
+ */
+public class MyUdpTmDataLink extends AbstractTmDataLink implements Runnable {
+
+    // Largest UDP payload over IPv4
+    static final int MAX_LENGTH = 65507;
+
+    // Length of the CCSDS primary header
+    static final int HEADER_LENGTH = 6;
+
+    private volatile int datagramCount = 0;
+    private volatile int truncatedCount = 0;
+
+    private DatagramSocket tmSocket;
+    private int port;
+    private DatagramPacket datagram;
+
+    @Override
+    public void init(String instance, String name, YConfiguration config) throws ConfigurationException {
+        super.init(instance, name, config);
+        port = config.getInt("port");
+        int maxLength = config.getInt("maxLength", MAX_LENGTH);
+        datagram = new DatagramPacket(new byte[maxLength], maxLength);
+        initPreprocessor(instance, config);
+    }
+
+    @Override
+    public void doStart() {
+        if (!isDisabled()) {
+            try {
+                tmSocket = new DatagramSocket(port);
+                new Thread(this).start();
+            } catch (SocketException e) {
+                notifyFailed(e);
+            }
+        }
+        notifyStarted();
+    }
+
+    @Override
+    public void doStop() {
+        if (tmSocket != null) {
+            tmSocket.close();
+        }
+        notifyStopped();
+    }
+
+    @Override
+    public void run() {
+        while (isRunningAndEnabled()) {
+            try {
+                tmSocket.receive(datagram);
+                datagramCount++;
+                split(datagram.getData(), datagram.getOffset(), datagram.getOffset() + datagram.getLength());
+            } catch (IOException e) {
+                if (isRunningAndEnabled()) {
+                    log.warn("Exception thrown when reading from the UDP socket at port {}", port, e);
+                }
+            }
+        }
+    }
+
+    private void split(byte[] data, int offset, int end) {
+        while (offset < end) {
+            int length = end - offset;
+            if (length >= HEADER_LENGTH) {
+                int packetLength = (((data[offset + 4] & 0xFF) << 8) | (data[offset + 5] & 0xFF)) + 7;
+                if (packetLength <= length) {
+                    length = packetLength;
+                } else {
+                    truncatedCount++;
+                }
+            }
+            // A short or truncated remainder is passed on as it is, the preprocessor decides what to do with it
+            byte[] packet = Arrays.copyOfRange(data, offset, offset + length);
+            offset += length;
+
+            updateStats(packet.length);
+            TmPacket tmPacket = new TmPacket(timeService.getMissionTime(), packet);
+            tmPacket.setEarthRceptionTime(timeService.getHresMissionTime());
+            tmPacket = packetPreprocessor.process(tmPacket);
+            if (tmPacket != null) {
+                processPacket(tmPacket);
+            }
+        }
+    }
+
+    @Override
+    protected void doDisable() {
+        if (tmSocket != null) {
+            tmSocket.close();
+            tmSocket = null;
+        }
+    }
+
+    @Override
+    protected void doEnable() throws SocketException {
+        tmSocket = new DatagramSocket(port);
+        new Thread(this).start();
+    }
+
+    @Override
+    public String getDetailedStatus() {
+        if (isDisabled()) {
+            return "DISABLED";
+        } else {
+            return String.format("OK (UDP port %d, %d datagrams, %d truncated)", port, datagramCount,
+                    truncatedCount);
+        }
+    }
+
+    @Override
+    protected Status connectionStatus() {
+        return Status.OK;
+    }
+}
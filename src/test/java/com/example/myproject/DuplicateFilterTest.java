@@ -0,0 +1,82 @@
+package com.example.myproject;
+
+import static org.junit.jupiter.api.Assertions.assertArrayEquals;
+import static org.junit.jupiter.api.Assertions.assertEquals;
+import static org.junit.jupiter.api.Assertions.assertFalse;
+import static org.junit.jupiter.api.Assertions.assertTrue;
+
+import org.junit.jupiter.api.Test;
+
+public class DuplicateFilterTest {
+
+    static final int APID = 100;
+
+    @Test
+    public void testDuplicate() {
+        DuplicateFilter filter = DuplicateFilter.getInstance("test-duplicate", 4096, 60000);
+        assertFalse(filter.isDuplicate(APID, 5, 0));
+        assertTrue(filter.isDuplicate(APID, 5, 0));
+        assertFalse(filter.isDuplicate(APID, 6, 0));
+        assertTrue(filter.isDuplicate(APID, 5, 0));
+    }
+
+    @Test
+    public void testLate() {
+        DuplicateFilter filter = DuplicateFilter.getInstance("test-late", 4096, 60000);
+        GapLedger ledger = GapLedger.getInstance("test-late");
+        assertFalse(filter.isDuplicate(APID, 5, 0));
+        assertFalse(filter.isDuplicate(APID, 8, 0));
+        assertEquals(2, ledger.getMissingCount(APID));
+
+        assertFalse(filter.isDuplicate(APID, 6, 0));
+        assertTrue(filter.isDuplicate(APID, 6, 0));
+        assertFalse(filter.isDuplicate(APID, 7, 0));
+        assertEquals(0, ledger.getMissingCount(APID));
+    }
+
+    @Test
+    public void testWrapped() {
+        DuplicateFilter filter = DuplicateFilter.getInstance("test-wrapped", 4096, 60000);
+        GapLedger ledger = GapLedger.getInstance("test-wrapped");
+        assertFalse(filter.isDuplicate(APID, 0x3FFE, 0));
+        assertFalse(filter.isDuplicate(APID, 0x3FFF, 0));
+        assertFalse(filter.isDuplicate(APID, 0, 0));
+        assertFalse(filter.isDuplicate(APID, 1, 0));
+        assertTrue(filter.isDuplicate(APID, 0x3FFF, 0));
+        assertTrue(filter.isDuplicate(APID, 0, 0));
+        assertEquals(0, ledger.getMissingCount(APID));
+    }
+
+    @Test
+    public void testLateBeforeFirst() {
+        DuplicateFilter filter = DuplicateFilter.getInstance("test-late-before-first", 4096, 60000);
+        // The lagging link delivers the packet before the wrap after the first one
+        assertFalse(filter.isDuplicate(APID, 0, 0));
+        assertFalse(filter.isDuplicate(APID, 0x3FFF, 0));
+        assertTrue(filter.isDuplicate(APID, 0x3FFF, 0));
+        assertTrue(filter.isDuplicate(APID, 0, 0));
+    }
+
+    @Test
+    public void testOutsideWindow() {
+        DuplicateFilter filter = DuplicateFilter.getInstance("test-outside-window", 64, 60000);
+        for (int seq = 0; seq < 200; seq++) {
+            assertFalse(filter.isDuplicate(APID, seq, 0));
+        }
+        // Too old to tell, let through
+        assertFalse(filter.isDuplicate(APID, 10, 0));
+        assertTrue(filter.isDuplicate(APID, 190, 0));
+    }
+
+    @Test
+    public void testTimeout() {
+        DuplicateFilter filter = DuplicateFilter.getInstance("test-timeout", 4096, 1000);
+        GapLedger ledger = GapLedger.getInstance("test-timeout");
+        assertFalse(filter.isDuplicate(APID, 0x3FF0, 0));
+        // After the timeout, the count carries on forward and the missed packets are a gap
+        assertFalse(filter.isDuplicate(APID, 5, 2000));
+        assertEquals(1, ledger.getGaps(APID).size());
+        assertArrayEquals(new long[] { 0x7FF1, 0x8004 }, ledger.getGaps(APID).get(0));
+        assertTrue(filter.isDuplicate(APID, 5, 2000));
+    }
+}
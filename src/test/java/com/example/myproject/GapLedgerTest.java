@@ -0,0 +1,52 @@
+package com.example.myproject;
+
+import static org.junit.jupiter.api.Assertions.assertArrayEquals;
+import static org.junit.jupiter.api.Assertions.assertEquals;
+
+import java.util.List;
+
+import org.junit.jupiter.api.Test;
+
+public class GapLedgerTest {
+
+    private static void assertGaps(GapLedger ledger, int apid, long[]... expected) {
+        List<long[]> gaps = ledger.getGaps(apid);
+        assertEquals(expected.length, gaps.size());
+        for (int i = 0; i < expected.length; i++) {
+            assertArrayEquals(expected[i], gaps.get(i));
+        }
+    }
+
+    @Test
+    public void testMerge() {
+        GapLedger ledger = GapLedger.getInstance("test-merge");
+        ledger.addGap(1, 10, 20);
+        ledger.addGap(1, 21, 25); // adjacent
+        assertGaps(ledger, 1, new long[] { 10, 25 });
+        ledger.addGap(1, 5, 12); // overlapping
+        assertGaps(ledger, 1, new long[] { 5, 25 });
+        ledger.addGap(1, 30, 40);
+        assertGaps(ledger, 1, new long[] { 5, 25 }, new long[] { 30, 40 });
+        assertEquals(32, ledger.getMissingCount(1));
+    }
+
+    @Test
+    public void testFill() {
+        GapLedger ledger = GapLedger.getInstance("test-fill");
+        ledger.addGap(1, 5, 25);
+        ledger.fill(1, 15); // splits
+        ledger.fill(1, 5); // shrinks
+        ledger.fill(1, 100); // not missing
+        assertGaps(ledger, 1, new long[] { 6, 14 }, new long[] { 16, 25 });
+        assertEquals(19, ledger.getMissingCount(1));
+    }
+
+    @Test
+    public void testFillSeqCount() {
+        GapLedger ledger = GapLedger.getInstance("test-fill-seq-count");
+        ledger.addGap(2, 0x4005, 0x4007); // after the counter wrapped once
+        ledger.fillSeqCount(2, 6);
+        assertGaps(ledger, 2, new long[] { 0x4005, 0x4005 }, new long[] { 0x4007, 0x4007 });
+        assertEquals(2, ledger.getMissingCount(2));
+    }
+}
@@ -0,0 +1,319 @@
+import argparse
+import hashlib
+import mmap
+import os
+import pickle
+import xml.etree.ElementTree as ET
+from time import perf_counter
+
+import numpy as np
+
+from simulator import index_packets, load_index, parse_elapsed
+
+XTCE_FILE = 'src/main/yamcs/mdb/xtce.xml'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'yamcs-quickstart')
+
+# Bump when the compiled layout changes, to invalidate existing caches
+CACHE_VERSION = 1
+
+
+def strip_ns(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def children(element, name):
+    return [child for child in element if strip_ns(child.tag) == name]
+
+
+def child(element, name):
+    found = children(element, name)
+    return found[0] if found else None
+
+
+def descendants(element, name):
+    return [e for e in element.iter() if strip_ns(e.tag) == name]
+
+
+class Leaf():
+    # A fixed-size, non-aggregate parameter (or aggregate member)
+
+    def __init__(self, name, kind, bits, signed=False, labels=None):
+        self.name = name
+        self.kind = kind  # 'int', 'float', 'bool' or 'enum'
+        self.bits = bits
+        self.signed = signed
+        self.labels = labels or {}
+
+
+class CompiledContainer():
+
+    def __init__(self, name):
+        self.name = name
+        self.fields = []     # (name, byte offset, numpy format), byte aligned
+        self.bitfields = []  # (name, bit offset, size in bits, signed)
+        self.criteria = []   # (name, value) comparisons against other columns
+        self.labels = {}     # enumeration labels, per column
+        self.size = 0        # minimum packet length in bytes
+
+    @staticmethod
+    def from_dict(d):
+        container = CompiledContainer(d['name'])
+        for key in ('fields', 'bitfields', 'criteria', 'labels', 'size'):
+            setattr(container, key, d[key])
+        return container
+
+    def dtype(self, itemsize):
+        names, offsets, formats = zip(*self.fields) if self.fields else ((), (), ())
+        return np.dtype({'names': list(names), 'formats': list(formats),
+                         'offsets': list(offsets), 'itemsize': itemsize})
+
+
+def parse_types(space_system):
+    types = {}
+    for type_set in descendants(space_system, 'ParameterTypeSet'):
+        for t in type_set:
+            types[t.get('name')] = t
+    return types
+
+
+def resolve(name, type_name, types):
+    # Flattens a parameter type into its leaves
+    t = types[type_name]
+    kind = strip_ns(t.tag)
+    if kind == 'AggregateParameterType':
+        leaves = []
+        for member in descendants(t, 'Member'):
+            leaves += resolve(name + '.' + member.get('name'), member.get('typeRef'), types)
+        return leaves
+
+    encoding = child(t, 'IntegerDataEncoding')
+    if encoding is None:
+        encoding = child(t, 'FloatDataEncoding')
+    bits = int(encoding.get('sizeInBits', 32))
+    if kind == 'FloatParameterType':
+        return [Leaf(name, 'float', bits)]
+    if kind == 'BooleanParameterType':
+        labels = {0: t.get('zeroStringValue', 'False'), 1: t.get('oneStringValue', 'True')}
+        return [Leaf(name, 'bool', bits, labels=labels)]
+    if kind == 'EnumeratedParameterType':
+        labels = {int(e.get('value')): e.get('label') for e in descendants(t, 'Enumeration')}
+        return [Leaf(name, 'enum', bits, labels=labels)]
+    signed = encoding.get('encoding', 'unsigned') != 'unsigned'
+    return [Leaf(name, 'int', bits, signed=signed)]
+
+
+def numpy_format(leaf):
+    if leaf.kind == 'float':
+        return '>f{}'.format(leaf.bits // 8)
+    if leaf.kind == 'bool' and leaf.bits == 8:
+        return '?'
+    return '>{}{}'.format('i' if leaf.signed else 'u', leaf.bits // 8)
+
+
+def compile_xtce(path):
+    root = ET.parse(path).getroot()
+    types = parse_types(root)
+    parameters = {p.get('name'): p.get('parameterTypeRef') for p in descendants(root, 'Parameter')}
+    sequence_containers = {c.get('name'): c for c in descendants(root, 'SequenceContainer')}
+    leaves = {}
+
+    def chain(container):
+        base = child(container, 'BaseContainer')
+        parent = [] if base is None else chain(sequence_containers[base.get('containerRef')])
+        return parent + [container]
+
+    compiled = []
+    for name, container in sequence_containers.items():
+        if container.get('abstract') == 'true':
+            continue
+        result = CompiledContainer(name)
+        position = 0
+        for c in chain(container):
+            for entry in descendants(c, 'ParameterRefEntry'):
+                ref = entry.get('parameterRef')
+                location = child(entry, 'LocationInContainerInBits')
+                bit = position
+                if location is not None:
+                    fixed = int(child(location, 'FixedValue').text)
+                    if location.get('referenceLocation', 'previousEntry') == 'containerStart':
+                        bit = fixed
+                    else:
+                        bit = position + fixed
+                for leaf in resolve(ref, parameters[ref], types):
+                    leaves[leaf.name] = leaf
+                    if leaf.labels and leaf.kind == 'enum':
+                        result.labels[leaf.name] = leaf.labels
+                    if bit % 8 == 0 and leaf.bits in (8, 16, 32, 64):
+                        result.fields.append((leaf.name, bit // 8, numpy_format(leaf)))
+                    else:
+                        result.bitfields.append((leaf.name, bit, leaf.bits, leaf.signed))
+                    bit += leaf.bits
+                position = max(position, bit)
+
+            base = child(c, 'BaseContainer')
+            if base is not None:
+                for comparison in descendants(base, 'Comparison'):
+                    result.criteria.append((comparison.get('parameterRef').replace('/', '.'),
+                                            comparison.get('value')))
+        result.size = (position + 7) // 8
+        compiled.append(result)
+
+    # Comparison values may be labels, turn them into raw values
+    for container in compiled:
+        criteria = []
+        for name, value in container.criteria:
+            labels = {label: raw for raw, label in leaves[name].labels.items()}
+            criteria.append((name, labels[value] if value in labels else int(value)))
+        container.criteria = criteria
+    return Decoder(compiled)
+
+
+def load_decoder(path=XTCE_FILE, cache_dir=CACHE_DIR):
+    # Compiled decoders are cached under the hash of the XTCE file
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    cache_file = os.path.join(cache_dir, 'xtce-{}-v{}.pickle'.format(digest[:16], CACHE_VERSION))
+    try:
+        with open(cache_file, 'rb') as f:
+            return Decoder([CompiledContainer.from_dict(c) for c in pickle.load(f)])
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+        pass
+
+    decoder = compile_xtce(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        # Plain data only, so the cache does not depend on how we were imported
+        pickle.dump([vars(c) for c in decoder.containers], f)
+    os.replace(tmp_file, cache_file)
+    return decoder
+
+
+def extract_bits(rows, bit, size, signed):
+    # Big-endian bit field of up to 57 bits, for every row at once
+    first = bit // 8
+    last = (bit + size - 1) // 8
+    value = np.zeros(len(rows), dtype=np.uint64)
+    for b in range(first, last + 1):
+        value = (value << np.uint64(8)) | rows[:, b]
+    value >>= np.uint64((last + 1) * 8 - bit - size)
+    value &= np.uint64((1 << size) - 1)
+    if signed:
+        value = value.astype(np.int64)
+        value -= (value >> (size - 1)) << size
+    return value
+
+
+class Decoder():
+
+    def __init__(self, containers):
+        self.containers = containers
+
+    def decode(self, data, offsets=None):
+        # Decodes a buffer of back-to-back CCSDS packets. Returns a dict of
+        # container name to columns. Byte-aligned columns are views of 'data'
+        # when the packets have a fixed size.
+        raw = np.frombuffer(data, dtype=np.uint8)
+        if offsets is None:
+            offsets = fixed_stride(raw)
+        if offsets is None:
+            offsets = np.frombuffer(index_packets(data), dtype=np.uint64).astype(np.int64)
+        else:
+            offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.diff(offsets)
+        starts = offsets[:-1]
+
+        stride = int(lengths[0]) if len(lengths) else 0
+        uniform = len(lengths) and (lengths == stride).all()
+        if uniform:
+            rows = raw[starts[0]:starts[0] + stride * len(lengths)].reshape(-1, stride)
+
+        result = {}
+        for container in self.containers:
+            selected = lengths >= container.size
+            if uniform:
+                table = rows
+            else:
+                width = container.size
+                index = starts[selected][:, None] + np.arange(width)
+                table = raw[index]
+            header = self._bitfields(container, table)
+            match = np.ones(len(table), dtype=bool)
+            for name, value in container.criteria:
+                column = header[name] if name in header else self._fields(container, table)[name]
+                match &= column == value
+            if uniform:
+                match &= selected
+            if not match.any():
+                continue
+
+            if match.all():
+                columns = self._fields(container, table)
+                columns.update(header)
+            else:
+                table = table[match]
+                columns = self._fields(container, table)
+                columns.update({k: v[match] for k, v in header.items()})
+            result[container.name] = columns
+        return result
+
+    def _fields(self, container, table):
+        records = table.view(container.dtype(table.shape[1]))[:, 0]
+        return {name: records[name] for name, _, _ in container.fields}
+
+    def _bitfields(self, container, table):
+        return {name: extract_bits(table, bit, size, signed)
+                for name, bit, size, signed in container.bitfields}
+
+
+def summarize(decoder, data, parameters, offsets=None):
+    start = perf_counter()
+    containers = decoder.decode(data, offsets)
+    print('Decoded in {:.1f} ms'.format((perf_counter() - start) * 1000))
+    for container, columns in containers.items():
+        for name in parameters or list(columns):
+            if name in columns:
+                column = columns[name].astype(np.float64)
+                print('{}/{}: n={} min={:g} max={:g} mean={:g}'.format(
+                    container, name, len(column), column.min(), column.max(), column.mean()))
+
+
+def fixed_stride(raw):
+    # Offsets for a capture made of equally sized packets, or None
+    if len(raw) < 6:
+        return None
+    stride = ((int(raw[4]) << 8) | int(raw[5])) + 7
+    if len(raw) % stride:
+        return None
+    rows = raw.reshape(-1, stride)
+    lengths = (rows[:, 4].astype(np.int64) << 8) | rows[:, 5]
+    if (lengths != stride - 7).any():
+        return None
+    return np.arange(0, len(raw) + 1, stride, dtype=np.int64)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode a CCSDS capture offline using the XTCE MDB')
+    parser.add_argument('file', help='CCSDS capture')
+    parser.add_argument('--xtce', default=XTCE_FILE,
+                        help='XTCE file (default: %(default)s)')
+    parser.add_argument('parameters', nargs='*',
+                        help='parameters to summarize (default: all)')
+    parser.add_argument('--start', type=parse_elapsed,
+                        help='onboard time to start from, in seconds or [D:]HH:MM[:SS]')
+    parser.add_argument('--stop', type=parse_elapsed,
+                        help='onboard time to stop at, in seconds or [D:]HH:MM[:SS]')
+    args = parser.parse_intermixed_args()
+
+    start = perf_counter()
+    decoder = load_decoder(args.xtce)
+    print('Loaded decoder in {:.1f} ms'.format((perf_counter() - start) * 1000))
+    with open(args.file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offsets = None
+        if args.start is not None or args.stop is not None:
+            # Slice through the sidecar index instead of scanning the capture
+            index = load_index(args.file, data)
+            first = 0 if args.start is None else index.find(args.start)
+            last = len(index) if args.stop is None else index.find(args.stop)
+            offsets = index.offsets[first:last + 1]
+        summarize(decoder, data, args.parameters, offsets)
@@ -0,0 +1,244 @@
+import argparse
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Layout of the Spacecraft container in mdb/xtce.xml, including the
+# CCSDS primary header. All fields are big-endian.
+SPACECRAFT = np.dtype([
+    ('CCSDS_Packet_ID', '>u2'),
+    ('CCSDS_Packet_Sequence', '>u2'),
+    ('CCSDS_Packet_Length', '>u2'),
+    ('EpochUSNO', '>f4'),
+    ('OrbitNumberCumulative', '>u4'),
+    ('ElapsedSeconds', '>u4'),
+    ('A', '>f4'),
+    ('Height', '>f4'),
+    ('Position', '>f4', 3),
+    ('Velocity', '>f4', 3),
+    ('Latitude', '>f4'),
+    ('Longitude', '>f4'),
+    ('Battery1_Voltage', '>f4'),
+    ('Battery2_Voltage', '>f4'),
+    ('Battery1_Temp', '>f4'),
+    ('Battery2_Temp', '>f4'),
+    ('Magnetometer', '>f4', 3),
+    ('Sunsensor', '>f4'),
+    ('Gyro', '>f4', 3),
+    ('Detector_Temp', '>f4'),
+    ('Shadow', 'u1'),
+    ('Contact_Golbasi_GS', 'u1'),
+    ('Contact_Svalbard', 'u1'),
+    ('Payload_Status', 'u1'),
+    ('Payload_Error_Flag', 'u1'),
+    ('ADCS_Error_Flag', 'u1'),
+    ('CDHS_Error_Flag', 'u1'),
+    ('COMMS_Error_Flag', 'u1'),
+    ('EPS_Error_Flag', 'u1'),
+    ('COMMS_Status', 'u1'),
+    ('CDHS_Status', 'u1'),
+    ('Mode_Night', 'u1'),
+    ('Mode_Day', 'u1'),
+    ('Mode_Payload', 'u1'),
+    ('Mode_XBand', 'u1'),
+    ('Mode_SBand', 'u1'),
+    ('Mode_Safe', 'u1'),
+])
+
+MU = 398600.4418  # km^3/s^2
+EARTH_RADIUS = 6378.137  # km
+MJD_UNIX_EPOCH = 40587
+
+# Latitude, longitude (degrees) of the ground stations in the MDB
+STATIONS = {
+    'Contact_Golbasi_GS': (39.79, 32.81),
+    'Contact_Svalbard': (78.23, 15.41),
+}
+MIN_ELEVATION = np.radians(5)
+
+
+class Orbit():
+
+    def __init__(self, a=7187.0, e=0.001, i=98.5, raan=330.0, argp=0.0, m0=0.0):
+        self.a = a
+        self.e = e
+        self.i = np.radians(i)
+        self.raan = np.radians(raan)
+        self.argp = np.radians(argp)
+        self.m0 = np.radians(m0)
+        self.n = np.sqrt(MU / a**3)
+
+    def propagate(self, t):
+        # Two-body Keplerian motion, returns ECI position and velocity (km, km/s)
+        m = self.m0 + self.n * t
+        ea = m.copy()
+        for _ in range(6):
+            ea -= (ea - self.e * np.sin(ea) - m) / (1 - self.e * np.cos(ea))
+        cos_e, sin_e = np.cos(ea), np.sin(ea)
+        b = self.a * np.sqrt(1 - self.e**2)
+        edot = self.n / (1 - self.e * cos_e)
+        perifocal_r = np.stack([self.a * (cos_e - self.e), b * sin_e], axis=-1)
+        perifocal_v = np.stack([-self.a * sin_e * edot, b * cos_e * edot], axis=-1)
+
+        co, so = np.cos(self.raan), np.sin(self.raan)
+        cw, sw = np.cos(self.argp), np.sin(self.argp)
+        ci, si = np.cos(self.i), np.sin(self.i)
+        rotation = np.array([
+            [co * cw - so * sw * ci, -co * sw - so * cw * ci],
+            [so * cw + co * sw * ci, -so * sw + co * cw * ci],
+            [sw * si, cw * si],
+        ])
+        return perifocal_r @ rotation.T, perifocal_v @ rotation.T
+
+    def orbit_number(self, t):
+        return 1 + np.floor((self.m0 + self.argp + self.n * t) / (2 * np.pi))
+
+
+def sun_direction(mjd):
+    # Low-precision solar ephemeris, good enough for eclipse modelling
+    d = mjd - 51544.5
+    mean_anomaly = np.radians(357.529 + 0.98560028 * d)
+    longitude = np.radians(280.459 + 0.98564736 * d) \
+        + np.radians(1.915) * np.sin(mean_anomaly) + np.radians(0.020) * np.sin(2 * mean_anomaly)
+    obliquity = np.radians(23.439)
+    return np.stack([np.cos(longitude),
+                     np.cos(obliquity) * np.sin(longitude),
+                     np.sin(obliquity) * np.sin(longitude)], axis=-1)
+
+
+def greenwich_angle(mjd):
+    return np.radians(280.46061837 + 360.98564736629 * (mjd - 51544.5)) % (2 * np.pi)
+
+
+def relax(active, t, low, high, tau):
+    # First-order response towards 'high' while active, else towards 'low',
+    # restarting at every transition. Vectorized over the whole range.
+    change = np.flatnonzero(np.diff(active.astype(np.int8))) + 1
+    starts = np.zeros(len(active), dtype=np.int64)
+    starts[change] = change
+    np.maximum.accumulate(starts, out=starts)
+    progress = 1 - np.exp(-(t - t[starts]) / tau)
+    return np.where(active, low + (high - low) * progress, high - (high - low) * progress)
+
+
+def generate(start_mjd, elapsed, orbit, apid=100, seq=0):
+    # Computes one Spacecraft packet per entry of 'elapsed' (seconds since
+    # start_mjd) and returns them as a structured array.
+    t = np.asarray(elapsed, dtype=np.float64)
+    mjd = start_mjd + t / 86400
+    count = len(t)
+    packets = np.zeros(count, dtype=SPACECRAFT)
+
+    packets['CCSDS_Packet_ID'] = apid & 0x7FF
+    packets['CCSDS_Packet_Sequence'] = 0xC000 | ((seq + np.arange(count)) & 0x3FFF)
+    packets['CCSDS_Packet_Length'] = SPACECRAFT.itemsize - 7
+    packets['EpochUSNO'] = mjd
+    packets['OrbitNumberCumulative'] = orbit.orbit_number(t)
+    packets['ElapsedSeconds'] = t
+    packets['A'] = orbit.a
+
+    position, velocity = orbit.propagate(t)
+    radius = np.linalg.norm(position, axis=1)
+    packets['Position'] = position
+    packets['Velocity'] = velocity
+    packets['Height'] = radius - EARTH_RADIUS
+
+    theta = greenwich_angle(mjd)
+    cos_t, sin_t = np.cos(theta), np.sin(theta)
+    ecef = np.stack([cos_t * position[:, 0] + sin_t * position[:, 1],
+                     -sin_t * position[:, 0] + cos_t * position[:, 1],
+                     position[:, 2]], axis=-1)
+    latitude = np.degrees(np.arcsin(ecef[:, 2] / radius))
+    packets['Latitude'] = latitude
+    packets['Longitude'] = np.degrees(np.arctan2(ecef[:, 1], ecef[:, 0])) % 360
+
+    # Cylindrical Earth shadow
+    sun = sun_direction(mjd)
+    along = np.einsum('ij,ij->i', position, sun)
+    across = np.linalg.norm(position - along[:, None] * sun, axis=1)
+    shadow = (along < 0) & (across < EARTH_RADIUS)
+    sunlit = ~shadow
+
+    contact = np.zeros(count, dtype=bool)
+    for name, (lat, lon) in STATIONS.items():
+        lat, lon = np.radians(lat), np.radians(lon)
+        up = np.array([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+        line_of_sight = ecef - EARTH_RADIUS * up
+        elevation = np.arcsin(line_of_sight @ up / np.linalg.norm(line_of_sight, axis=1))
+        visible = elevation > MIN_ELEVATION
+        packets[name] = visible
+        contact |= visible
+
+    packets['Battery1_Voltage'] = relax(sunlit, t, 24.0, 32.0, 900)
+    packets['Battery2_Voltage'] = relax(sunlit, t, 24.5, 32.0, 1100)
+    packets['Battery1_Temp'] = relax(sunlit, t, 5.0, 55.0, 1500)
+    packets['Battery2_Temp'] = relax(sunlit, t, 5.0, 52.0, 1700)
+
+    sun_angle = np.einsum('ij,ij->i', position / radius[:, None], sun)
+    packets['Sunsensor'] = np.where(sunlit, 1600 * np.clip(sun_angle, 0, 1), 1e-6)
+
+    # Tilted dipole seen from the orbit: field strength grows towards the poles
+    lat_rad = np.radians(latitude)
+    scale = np.sqrt(1 + 3 * np.sin(lat_rad)**2) / 2
+    packets['Magnetometer'] = np.stack([1500 + 300 * np.cos(lat_rad),
+                                        1875 + 375 * np.sin(lat_rad),
+                                        1492.5 + 1107.5 * scale], axis=-1)
+    phase = orbit.n * t
+    packets['Gyro'] = np.stack([30 * np.sin(phase * 3), 24 * np.sin(phase * 5 + 1),
+                                28 * np.sin(phase * 7 + 2)], axis=-1)
+
+    payload = sunlit & (np.abs(latitude) < 60) & ~contact
+    packets['Detector_Temp'] = relax(payload, t, 0.0, 35.1, 600)
+
+    packets['Shadow'] = shadow
+    packets['Payload_Status'] = payload
+    packets['COMMS_Status'] = contact
+    packets['CDHS_Status'] = 1
+    packets['Mode_Night'] = shadow
+    packets['Mode_Day'] = sunlit
+    packets['Mode_Payload'] = payload
+    packets['Mode_XBand'] = packets['Contact_Golbasi_GS']
+    packets['Mode_SBand'] = packets['Contact_Svalbard']
+    return packets
+
+
+def generate_fleet(start_mjd, start, count, spacecraft=1, apid=100, chunk=86400):
+    # Yields interleaved packets for several satellites spread evenly over
+    # the same orbital plane, one chunk at a time to bound memory use.
+    orbits = [Orbit(m0=360.0 * k / spacecraft) for k in range(spacecraft)]
+    for offset in range(0, count, chunk):
+        elapsed = np.arange(start + offset, start + min(count, offset + chunk))
+        packets = np.empty((len(elapsed), spacecraft), dtype=SPACECRAFT)
+        for k, orbit in enumerate(orbits):
+            packets[:, k] = generate(start_mjd, elapsed, orbit, apid + k, start + offset)
+        yield packets.reshape(-1)
+
+
+def to_mjd(date):
+    return date.replace(tzinfo=timezone.utc).timestamp() / 86400 + MJD_UNIX_EPOCH
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate Spacecraft telemetry from an orbit model')
+    parser.add_argument('output', help='CCSDS file to write, or - for stdout')
+    parser.add_argument('--start', default='2016-01-01',
+                        help='start date, YYYY-MM-DD (default: %(default)s)')
+    parser.add_argument('--days', type=float, default=1.0,
+                        help='length of the generated range in days (default: %(default)s)')
+    parser.add_argument('--spacecraft', type=int, default=1,
+                        help='number of satellites, interleaved each second (default: %(default)s)')
+    parser.add_argument('--apid', type=int, default=100,
+                        help='APID of the first satellite, the others count up from it (default: %(default)s)')
+    args = parser.parse_args()
+
+    start_mjd = to_mjd(datetime.strptime(args.start, '%Y-%m-%d'))
+    count = int(args.days * 86400)
+
+    out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        for packets in generate_fleet(start_mjd, 0, count, args.spacecraft, args.apid):
+            out.write(packets.tobytes())
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
@@ -0,0 +1,233 @@
+import argparse
+import json
+import os
+from time import perf_counter
+
+import numpy as np
+
+from tmstore import ParameterStore, parse_time
+
+# Bucket widths of the pyramid, finest first
+LEVELS = (
+    np.timedelta64(10, 's'),
+    np.timedelta64(1, 'm'),
+    np.timedelta64(10, 'm'),
+    np.timedelta64(1, 'h'),
+)
+
+# Where a store keeps its saved pyramid
+ROLLUP_DIRECTORY = 'rollup'
+STATISTICS = ('sum', 'min', 'max')
+
+
+class Level():
+    # min/max/sum/count buckets of a fixed width, starting at 'origin'
+
+    def __init__(self, width, origin, names):
+        self.width = width.astype('timedelta64[ms]')
+        self.origin = origin
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sum = {name: np.zeros(0) for name in names}
+        self.min = {name: np.zeros(0) for name in names}
+        self.max = {name: np.zeros(0) for name in names}
+
+    def _grow(self, size):
+        extra = size - len(self.count)
+        if extra <= 0:
+            return
+        # Grow geometrically, so that per-packet updates stay amortized O(1)
+        extra = max(extra, len(self.count))
+        self.count = np.concatenate([self.count, np.zeros(extra, dtype=np.int64)])
+        for name in self.sum:
+            self.sum[name] = np.concatenate([self.sum[name], np.zeros(extra)])
+            self.min[name] = np.concatenate([self.min[name], np.full(extra, np.inf)])
+            self.max[name] = np.concatenate([self.max[name], np.full(extra, -np.inf)])
+
+    def add(self, times, columns):
+        index = (times - self.origin) // self.width
+        self._grow(int(index.max()) + 1)
+        if (np.diff(index) >= 0).all():
+            # Sorted input: reduce each run of equal buckets in one go
+            starts = np.concatenate([[0], np.flatnonzero(np.diff(index)) + 1])
+            buckets = index[starts]
+            self.count[buckets] += np.diff(np.append(starts, len(index)))
+            for name, values in columns.items():
+                values = np.asarray(values, dtype=np.float64)
+                self.sum[name][buckets] += np.add.reduceat(values, starts)
+                low, high = self.min[name], self.max[name]
+                low[buckets] = np.minimum(low[buckets], np.minimum.reduceat(values, starts))
+                high[buckets] = np.maximum(high[buckets], np.maximum.reduceat(values, starts))
+        else:
+            np.add.at(self.count, index, 1)
+            for name, values in columns.items():
+                values = np.asarray(values, dtype=np.float64)
+                np.add.at(self.sum[name], index, values)
+                np.minimum.at(self.min[name], index, values)
+                np.maximum.at(self.max[name], index, values)
+
+    def save(self, directory, prefix):
+        # count as one array, each statistic as one row per parameter
+        used = np.flatnonzero(self.count)
+        size = int(used[-1]) + 1 if len(used) else 0
+        np.save(os.path.join(directory, prefix + '.count.npy'), self.count[:size])
+        for statistic in STATISTICS:
+            values = getattr(self, statistic)
+            rows = np.stack([values[name][:size] for name in values])
+            np.save(os.path.join(directory, '{}.{}.npy'.format(prefix, statistic)), rows)
+
+    @classmethod
+    def load(cls, directory, prefix, width, origin, names):
+        # Copy-on-write mappings: queries only touch the buckets they need,
+        # and updates do not write through to the files
+        level = cls(width, origin, [])
+        level.count = np.load(os.path.join(directory, prefix + '.count.npy'), mmap_mode='c')
+        for statistic in STATISTICS:
+            rows = np.load(os.path.join(directory, '{}.{}.npy'.format(prefix, statistic)), mmap_mode='c')
+            setattr(level, statistic, dict(zip(names, rows)))
+        return level
+
+    def buckets(self, start, stop):
+        first = max(0, (start - self.origin) // self.width)
+        last = min(len(self.count), -((self.origin - stop) // self.width))
+        return slice(int(first), int(max(first, last)))
+
+
+class Rollup():
+    # Pyramid of time buckets for numeric parameters, fed incrementally
+    # with batches of samples. It can be saved next to a store, so that
+    # queries do not have to go through the samples again.
+
+    def __init__(self, names, store=None):
+        self.names = list(names)
+        self.store = store
+        self.levels = None
+        self.samples = 0
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for i, level in enumerate(self.levels or []):
+            level.save(directory, 'level{}'.format(i))
+        # Written last, so that an interrupted save is not picked up
+        meta = {'names': self.names, 'samples': self.samples}
+        if self.levels:
+            meta['origin'] = str(self.levels[0].origin)
+            meta['widths'] = [int(level.width / np.timedelta64(1, 'ms')) for level in self.levels]
+        with open(os.path.join(directory, 'rollup.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, directory, store=None):
+        # Returns the saved pyramid, or None if there is none
+        try:
+            with open(os.path.join(directory, 'rollup.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        rollup = cls(meta['names'], store)
+        rollup.samples = meta['samples']
+        if 'origin' in meta:
+            origin = np.datetime64(meta['origin'], 'ms')
+            rollup.levels = [Level.load(directory, 'level{}'.format(i), np.timedelta64(width, 'ms'),
+                                        origin, rollup.names)
+                             for i, width in enumerate(meta['widths'])]
+        return rollup
+
+    def update(self, times, columns):
+        times = np.asarray(times, dtype='datetime64[ms]')
+        if not len(times):
+            return
+        if self.levels is None:
+            # Align all levels to the start of the hour of the first sample
+            origin = times[0].astype('datetime64[h]').astype('datetime64[ms]')
+            self.levels = [Level(width, origin, self.names) for width in LEVELS]
+        if times.min() < self.levels[0].origin:
+            raise ValueError('Samples older than the first update are not supported')
+        columns = {name: columns[name] for name in self.names}
+        for level in self.levels:
+            level.add(times, columns)
+        self.samples += len(times)
+
+    def select_level(self, start, stop, pixels):
+        # Coarsest level that still has at least one bucket per pixel
+        resolution = (np.datetime64(stop, 'ms') - np.datetime64(start, 'ms')) / pixels
+        selected = None
+        for level in self.levels or []:
+            if level.width <= resolution:
+                selected = level
+        return selected
+
+    def query(self, name, start, stop, pixels):
+        # Returns bucket start times, min, max, mean and count. Falls back to
+        # the raw samples when even the finest level is too coarse.
+        start = np.datetime64(start, 'ms')
+        stop = np.datetime64(stop, 'ms')
+        level = self.select_level(start, stop, pixels)
+        if level is None:
+            if self.store is None:
+                raise ValueError('Requested resolution is finer than the rollup')
+            times, columns = self.store.query(start, stop, [name])
+            values = columns[name].astype(np.float64)
+            return times, values, values, values, np.ones(len(values), dtype=np.int64)
+
+        s = level.buckets(start, stop)
+        count = level.count[s]
+        present = count > 0
+        times = level.origin + level.width * np.arange(s.start, s.stop)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = level.sum[name][s] / count
+        return (times[present], level.min[name][s][present], level.max[name][s][present],
+                mean[present], count[present])
+
+
+def numeric_parameters(store):
+    return [name for name in store.parameters if store.column(name).dtype.kind in 'biuf']
+
+
+def build_rollup(store, chunk=3600):
+    rollup = Rollup(numeric_parameters(store), store)
+    for first in range(0, len(store.time), chunk):
+        s = slice(first, first + chunk)
+        rollup.update(store.time[s], {name: store.column(name)[s] for name in rollup.names})
+    return rollup
+
+
+def save_rollup(store):
+    rollup = build_rollup(store)
+    rollup.save(os.path.join(store.directory, ROLLUP_DIRECTORY))
+    return rollup
+
+
+def load_rollup(store):
+    # Saved pyramid of a store, rebuilt if it is missing or out of date
+    rollup = Rollup.load(os.path.join(store.directory, ROLLUP_DIRECTORY), store)
+    if rollup is None or rollup.samples != len(store.time) or rollup.names != numeric_parameters(store):
+        rollup = save_rollup(store)
+    return rollup
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Min/max/mean rollups for plotting stored TM')
+    parser.add_argument('store', help='store directory, see tmstore.py')
+    parser.add_argument('parameter', help='parameter to plot')
+    parser.add_argument('--start', help='start time (default: first sample)')
+    parser.add_argument('--stop', help='stop time (default: after the last sample)')
+    parser.add_argument('--pixels', type=int, default=1000,
+                        help='horizontal resolution of the plot (default: %(default)s)')
+    args = parser.parse_args()
+
+    store = ParameterStore(args.store)
+    start = perf_counter()
+    rollup = load_rollup(store)
+    print('Loaded rollup of {} parameters in {:.1f} ms'.format(
+        len(rollup.names), (perf_counter() - start) * 1000))
+
+    first = parse_time(args.start, store) if args.start else store.time[0]
+    last = parse_time(args.stop, store) if args.stop else store.time[-1] + np.timedelta64(1, 'ms')
+    start = perf_counter()
+    level = rollup.select_level(first, last, args.pixels)
+    times, low, high, mean, count = rollup.query(args.parameter, first, last, args.pixels)
+    print('{} points at {} resolution in {:.2f} ms'.format(
+        len(times), level.width if level else 'raw', (perf_counter() - start) * 1000))
+    if len(times):
+        print('min={:g} max={:g} mean={:g}'.format(
+            low.min(), high.max(), np.sum(mean * count) / np.sum(count)))
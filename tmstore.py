@@ -0,0 +1,133 @@
+import argparse
+import json
+import mmap
+import os
+from time import perf_counter
+
+import numpy as np
+
+from tmdecode import load_decoder
+
+MJD_EPOCH = np.datetime64('1858-11-17', 'ms')
+
+
+def packet_times(columns, start=None):
+    # Onboard time of each packet: the MJD day of the first EpochUSNO,
+    # unless given, plus ElapsedSeconds.
+    if start is None:
+        start = MJD_EPOCH + np.timedelta64(int(columns['EpochUSNO'][0]), 'D')
+    elapsed = columns['ElapsedSeconds'].astype(np.int64) * 1000
+    return np.datetime64(start, 'ms') + elapsed.astype('timedelta64[ms]')
+
+
+def write_columns(data, directory, container, start, decoder):
+    columns = decoder.decode(data)[container]
+    times = packet_times(columns, start)
+    order = None
+    if len(times) > 1 and (np.diff(times) < np.timedelta64(0)).any():
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+    np.save(os.path.join(directory, 'time.npy'), times)
+
+    for name, column in columns.items():
+        # Stored native-endian, so that queries need no conversion
+        column = column.astype(column.dtype.newbyteorder('='))
+        if order is not None:
+            column = column[order]
+        np.save(os.path.join(directory, name + '.npy'), column)
+    return len(times), list(columns)
+
+
+def build_store(capture, directory, container='Spacecraft', start=None, decoder=None):
+    decoder = decoder or load_decoder()
+    os.makedirs(directory, exist_ok=True)
+    with open(capture, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        count, parameters = write_columns(data, directory, container, start, decoder)
+
+    with open(os.path.join(directory, 'store.json'), 'w') as f:
+        json.dump({'container': container, 'count': count, 'parameters': parameters}, f)
+    store = ParameterStore(directory)
+
+    # Imported here, as tmrollup builds on this module
+    from tmrollup import save_rollup
+    save_rollup(store)
+    return store
+
+
+class ParameterStore():
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'store.json')) as f:
+            meta = json.load(f)
+        self.container = meta['container']
+        self.parameters = meta['parameters']
+        self.time = self._load('time')
+        self._columns = {}
+
+    def _load(self, name):
+        return np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r')
+
+    def column(self, name):
+        if name not in self._columns:
+            if name not in self.parameters:
+                raise KeyError('Unknown parameter: {}'.format(name))
+            self._columns[name] = self._load(name)
+        return self._columns[name]
+
+    def range(self, start, stop):
+        # Slice of packets with start <= time < stop, by binary search
+        first = np.searchsorted(self.time, np.datetime64(start, 'ms'), side='left')
+        last = np.searchsorted(self.time, np.datetime64(stop, 'ms'), side='left')
+        return slice(first, last)
+
+    def query(self, start, stop, parameters=None):
+        # Returns the time column and the requested parameters over the
+        # range, as views of the mapped files.
+        s = self.range(start, stop)
+        names = parameters or self.parameters
+        return self.time[s], {name: self.column(name)[s] for name in names}
+
+
+def parse_time(value, store):
+    # Full ISO timestamps, or a time of day relative to the first day in the store
+    if 'T' in value or len(value) == 10:
+        return np.datetime64(value, 'ms')
+    day = store.time[0].astype('datetime64[D]')
+    return np.datetime64('{}T{}'.format(day, value), 'ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Columnar parameter store for captured TM')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='decode a capture into a store')
+    build.add_argument('capture', help='CCSDS capture')
+    build.add_argument('store', help='store directory')
+    build.add_argument('--container', default='Spacecraft',
+                       help='container to store (default: %(default)s)')
+    build.add_argument('--start', help='date of ElapsedSeconds 0 (default: from EpochUSNO)')
+    query = subparsers.add_parser('query', help='query a time range')
+    query.add_argument('store', help='store directory')
+    query.add_argument('start', help='start time, ISO or HH:MM[:SS] on the first day')
+    query.add_argument('stop', help='stop time (exclusive)')
+    query.add_argument('parameters', nargs='*', help='parameters (default: all)')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = perf_counter()
+        store = build_store(args.capture, args.store, args.container, args.start)
+        print('Stored {} packets with {} parameters in {:.1f} s'.format(
+            len(store.time), len(store.parameters), perf_counter() - start))
+    else:
+        store = ParameterStore(args.store)
+        start = perf_counter()
+        times, columns = store.query(parse_time(args.start, store), parse_time(args.stop, store),
+                                     args.parameters)
+        elapsed = perf_counter() - start
+        print('{} samples from {} to {} in {:.2f} ms'.format(
+            len(times), times[0] if len(times) else '-', times[-1] if len(times) else '-',
+            elapsed * 1000))
+        for name, column in columns.items():
+            if len(column):
+                print('{}: min={:g} max={:g} mean={:g}'.format(
+                    name, np.min(column), np.max(column), np.mean(column, dtype=np.float64)))